@@ -0,0 +1,187 @@
+# Benchmarks for the unit conversion library.
+#
+# To run the benchmarks:
+# python benchmark.py
+#
+# To run with more repetitions:
+# python benchmark.py -r 50
+#
+# To save a baseline, and later check a change against it (exits with 1 when a category got slower):
+# python benchmark.py --save baseline.json
+# python benchmark.py --compare baseline.json
+
+import json
+import random
+import sys
+import time
+import timeit
+from argparse import ArgumentParser
+
+import unitconversion
+
+# Spec sheet style text, dense with units. Repeated until a message reaches the wanted length.
+DENSE_CHUNK = "width 12 ft, depth 3 in, weight 150 lbs, 5 gallons at 70 °F, 10 mph and 2 miles. "
+
+# Sample text for units whose friendly name is not matched by their own pattern.
+UNIT_ALIASES = {
+    "fluid ounce": "fl oz",
+    "British thermal unit": "btu",
+    "feet per second": "ft/s",
+}
+
+CHATTER_WORDS = ["hey", "lol", "what", "is", "the", "best", "game", "I", "think", "you", "are", "right", "ok", "no", "yes",
+                 "tomorrow", "at", "my", "place", "gg", "wp", "that", "was", "funny", ":)", "anyone", "here", "?", "brb", "sure"]
+
+
+def dense_message(length):
+    return (DENSE_CHUNK * (length // len(DENSE_CHUNK) + 1))[:length]
+
+
+def unit_samples():
+    """Returns a text matched by each unit of the units table."""
+    samples = []
+    for unit in unitconversion.units:
+        sample = UNIT_ALIASES.get(unit.getName(), unit.getName())
+        find = unit.matchAt(sample, 0)
+        if find is None or find.end() != len(sample):
+            raise ValueError("No sample text for unit '{}', add one to UNIT_ALIASES".format(unit.getName()))
+        samples.append(sample)
+    return samples
+
+
+def random_number(rng):
+    number = str(rng.randint(0, 2000))
+    if rng.random() < 0.3:
+        number += rng.choice([".", ","]) + str(rng.randint(0, 99))
+    return number
+
+
+def random_chatter(rng, words):
+    return " ".join(rng.choice(CHATTER_WORDS) for _ in range(words))
+
+
+def random_quantity(rng, samples):
+    return random_number(rng) + rng.choice([" ", ""]) + rng.choice(samples)
+
+
+def adversarial_messages():
+    """Long messages meant to find inputs where the matching is not linear."""
+    return [
+        "`" * 4000,
+        "`" + "a" * 3999,
+        ("` 5 ft >" * 500)[:4000],
+        "´" * 2000 + "`" * 2000,
+        "5" + " " * 3997 + "ft",
+        "1" * 4000,
+        "1 " * 2000,
+        "1," * 2000,
+        "5ft" * 1333,
+        "5 " + "°" * 3998,
+        ("5 degree " * 450)[:4000],
+        ("5 troy " * 600)[:4000],
+    ]
+
+
+def build_corpus(seed=0, size=300):
+    """Builds a deterministic synthetic corpus of messages, by category."""
+    rng = random.Random(seed)
+    samples = unit_samples()
+    return {
+        "chatter": [random_chatter(rng, rng.randint(3, 30)) for _ in range(size)],
+        "single": [random_chatter(rng, rng.randint(1, 15)) + " " + random_quantity(rng, samples) + " " + random_chatter(rng, rng.randint(0, 15))
+                   for _ in range(size)],
+        "dense": [", ".join(random_quantity(rng, samples) for _ in range(rng.randint(20, 80))) for _ in range(size // 10)],
+        "code": [random_chatter(rng, rng.randint(1, 10)) + " `" + random_quantity(rng, samples) + " " + random_chatter(rng, 5) + "` " + random_quantity(rng, samples)
+                 for _ in range(size)],
+        "adversarial": adversarial_messages(),
+    }
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+
+def bench_corpus(corpus, repeat):
+    """Measures messages/sec and p50/p99 latency of unitconversion.process per corpus category."""
+    print("Corpus (best of {} runs per message):".format(repeat))
+    results = {}
+    for category, messages in corpus.items():
+        latencies = []
+        for message in messages:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                unitconversion.process(message)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            latencies.append(best)
+        latencies.sort()
+        results[category] = {
+            "messagesPerSecond": len(latencies) / sum(latencies),
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+        }
+        print("  {:12s} {:5d} messages: {:10.0f} messages/s, p50 {:8.1f} µs, p99 {:8.1f} µs".format(
+            category, len(messages), results[category]["messagesPerSecond"], results[category]["p50"] * 10**6, results[category]["p99"] * 10**6))
+    return results
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Prints categories that got slower than the baseline by more than the tolerance. Returns whether any did."""
+    slower = False
+    for category, result in results.items():
+        if category not in baseline:
+            continue
+        for metric in ["p50", "p99"]:
+            ratio = result[metric] / baseline[category][metric]
+            if ratio > 1 + tolerance:
+                slower = True
+                print("  SLOWER: {} {} is {:.2f}x the baseline".format(category, metric, ratio))
+    if not slower:
+        print("  No category is slower than the baseline.")
+    return slower
+
+
+def bench_long_messages(repeat):
+    """Regression benchmark for long messages: the time per character should stay flat as messages grow."""
+    print("Long dense messages (Discord Nitro length):")
+    results = {}
+    for length in [500, 1000, 2000, 4000]:
+        message = dense_message(length)
+        seconds = min(timeit.repeat(lambda: unitconversion.process(message), number=1, repeat=repeat))
+        results[length] = seconds
+        print("  {:5d} chars, {:4d} numbers: {:8.3f} ms/message, {:6.2f} µs/char".format(
+            length, len(unitconversion.findNumbers(message)), seconds * 1000, seconds / length * 10**6))
+    print("  4000/2000 chars time ratio: {:.2f} (linear is 2.0, quadratic is 4.0)".format(results[4000] / results[2000]))
+
+
+def bench_unit_conversion(repeat):
+    """Microbenchmark of converting a single value: picking the multiple, rounding and formatting."""
+    print("Single value conversion:")
+    context = unitconversion.ConversionContext()
+    number = 100000
+    for unit in [unit for unit in unitconversion.units if unit.getName() in ["inch squared", "foot", "horsepower"]]:
+        seconds = min(timeit.repeat(lambda: unit.toMetric(12.5, context), number=number, repeat=repeat))
+        print("  {:20s}: {:6.3f} µs/conversion".format(unit.getName(), seconds / number * 10**6))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=20, help="Number of repetitions per benchmark")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument("--save", dest="save", help="Save the corpus results as a baseline to this file")
+    parser.add_argument("--compare", dest="compare", help="Compare the corpus results to the baseline in this file")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.25, help="Allowed slowdown relative to the baseline, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    bench_unit_conversion(args.repeat)
+    bench_long_messages(args.repeat)
+    corpusResults = bench_corpus(build_corpus(args.seed), max(1, args.repeat // 4))
+
+    if args.save:
+        with open(args.save, "w") as baselineFile:
+            json.dump(corpusResults, baselineFile, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as baselineFile:
+            if compare_baseline(corpusResults, json.load(baselineFile), args.tolerance):
+                sys.exit(1)
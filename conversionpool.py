@@ -0,0 +1,101 @@
+'''Runs unit conversions on a worker pool, so the asyncio event loop of the bot never blocks on them.'''
+
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import unitconversion
+
+
+class ConversionPool:
+    '''Executor backed conversion pipeline with a bounded queue and a per-message timeout.
+
+    When the queue is full new messages are dropped instead of queued, so under sustained load
+    the bot sheds conversions rather than falling behind on the gateway. A message that takes
+    longer than the timeout is skipped; its worker slot stays taken until the conversion ends.
+    '''
+
+    def __init__(self, workers=4, maxQueue=64, timeout=2.0, useProcesses=False, profiler=None):
+        executorClass = ProcessPoolExecutor if useProcesses else ThreadPoolExecutor
+        self._executor = executorClass(max_workers=workers)
+        self._workers = workers
+        self._maxQueue = maxQueue
+        self._timeout = timeout
+        self._useProcesses = useProcesses
+        # An instrumentation.SamplingProfiler that samples the conversions, only used with thread workers.
+        self._profiler = None if useProcesses else profiler
+        self._queued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.timedOut = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def getQueueDepth(self):
+        return self._queued
+
+    def getStats(self):
+        return {
+            "workers": self._workers,
+            "processes": self._useProcesses,
+            "queued": self._queued,
+            "maxQueue": self._maxQueue,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "timedOut": self.timedOut,
+            "averageLatency": self.totalLatency / self.processed if self.processed else 0.0,
+            "maxLatency": self.maxLatency,
+        }
+
+    def _release(self, future):
+        self._queued -= 1
+        if not future.cancelled():
+            # Retrieve the exception of conversions nobody waits for anymore, so asyncio does not complain about it.
+            future.exception()
+
+    async def process(self, message, context=None):
+        '''Converts a message like unitconversion.process. Returns None when the message was dropped or timed out.'''
+        return await self._run(unitconversion.process, message, context)
+
+    async def processIncremental(self, message, previous=None, context=None):
+        '''Converts an (edited) message like unitconversion.processIncremental. Returns None when the
+        message was dropped, timed out or went over its time budget.'''
+        return await self._run(unitconversion.processIncremental, message, previous, context)
+
+    async def _run(self, function, *args):
+        if self._queued >= self._maxQueue:
+            self.dropped += 1
+            return
+        self._queued += 1
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if self._profiler is not None:
+            future = loop.run_in_executor(self._executor, self._profiler.run, function, *args)
+        else:
+            future = loop.run_in_executor(self._executor, function, *args)
+        future.add_done_callback(self._release)
+        try:
+            # Shielded, so a timeout does not release the worker slot before the conversion has actually stopped.
+            result = await asyncio.wait_for(asyncio.shield(future), self._timeout)
+        except asyncio.TimeoutError:
+            self.timedOut += 1
+            return
+        latency = time.perf_counter() - start
+        self.processed += 1
+        self.totalLatency += latency
+        self.maxLatency = max(self.maxLatency, latency)
+        return result
+
+    def reloadUnits(self):
+        '''Makes the workers use a unit table that was swapped in with unitconversion.reloadUnits.
+
+        Threads share the registry of this process, so only worker processes need replacing. Their
+        conversions that are still running finish on the old processes, with the old table.
+        '''
+        if self._useProcesses:
+            oldExecutor = self._executor
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+            oldExecutor.shutdown(wait=False)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
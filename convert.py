@@ -0,0 +1,76 @@
+# Converts many messages at once, for example exported channel history or moderation logs.
+# Reads messages from stdin and writes the results to stdout, one per line, in the same order.
+#
+# Newline-delimited text, lines without units are written unchanged:
+# python convert.py < messages.txt > converted.txt
+#
+# JSONL, every line is a JSON string or an object with a "content" field.
+# Every output line is that object with a "converted" field added (null when nothing was converted).
+# Blank lines are skipped, invalid lines are written out with "converted" null and a warning:
+# python convert.py --jsonl < messages.jsonl > converted.jsonl
+#
+# To spread the work over 4 processes:
+# python convert.py -p 4 < messages.txt
+
+import json
+import sys
+from argparse import ArgumentParser
+from collections import deque
+
+import unitconversion
+
+
+# Yields (record, content) for every line. Bad JSONL records do not stop the run: a blank line is
+# skipped, and a line that is not JSON, or whose "content" is not a string, is written out with
+# "converted" null (a line that is not JSON as {"line": ...}), with a warning on stderr.
+def read_messages(lines, jsonl, warnings=sys.stderr):
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not jsonl:
+            yield line, line
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            warnings.write("Line {}: not valid JSON, not converted: {}\n".format(number, error))
+            yield {"line": line}, ""
+            continue
+        if not isinstance(record, dict):
+            record = {"content": record}
+        content = record.get("content")
+        if content is None:
+            content = ""
+        elif not isinstance(content, str):
+            warnings.write("Line {}: \"content\" is not a string, not converted\n".format(number))
+            content = ""
+        yield record, content
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--jsonl", dest="jsonl", action="store_true", help="Read and write JSON lines instead of plain text")
+    parser.add_argument("-p", "--processes", dest="processes", type=int, default=0, help="Number of worker processes, 0 converts in this process")
+    parser.add_argument("-c", "--chunksize", dest="chunksize", type=int, default=256, help="Number of messages per chunk sent to a worker process")
+    args = parser.parse_args()
+
+    records = deque()
+
+    def messages():
+        # Keeps the records in step with the messages, so results can be matched to their input in order.
+        for record, content in read_messages(sys.stdin, args.jsonl):
+            records.append(record)
+            yield content
+
+    for result in unitconversion.process_many(messages(), processes=args.processes, chunksize=args.chunksize):
+        record = records.popleft()
+        if args.jsonl:
+            record["converted"] = result
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            sys.stdout.write((result if result is not None else record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
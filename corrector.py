@@ -0,0 +1,92 @@
+'''The message path of the bot, without discord.py: decides whether a message is corrected, converts
+it on the worker pool, schedules the correction and corrects edited messages again. unitbot.py
+forwards its events here, and the load test and the tests drive it with fake Discord objects.'''
+
+import time
+from datetime import datetime
+
+import filter
+
+
+def getCorrectionText(message, processedMessage):
+    return ("I think " + filter.apply_strict(message.author.display_name if message.guild is not None else "you") +
+            " meant to say: ```" + filter.apply_strict(processedMessage) + "```")
+
+
+class Corrector:
+    '''Handles new, edited and deleted messages.
+
+    Uses a conversionpool.ConversionPool, guildsettings.GuildSettings and replyscheduler.ReplyScheduler.
+    With an edittracker.EditTracker (whose replySent should be the onSent of the scheduler) edits of
+    recent messages are corrected again; without one, edits are ignored. When metrics (see
+    instrumentation.Metrics) are given, the conversion and filter stages are recorded.
+    '''
+
+    def __init__(self, conversionPool, guildSettings, replyScheduler, editTracker=None, context=None, metrics=None):
+        self._conversionPool = conversionPool
+        self._guildSettings = guildSettings
+        self._replyScheduler = replyScheduler
+        self._editTracker = editTracker
+        self._context = context
+        self._metrics = metrics
+
+    async def onMessage(self, message, botUserId):
+        '''Corrects non-SI units in a message, if necessary. Most of the code behind this is in unitconversion.py.'''
+        if message.author.id == botUserId or message.author.bot or not self._guildSettings.shouldCorrect(message):
+            return
+        metrics = self._metrics
+        lapTime = time.perf_counter()
+        if self._editTracker is not None:
+            # The conversion is kept, so an edit of the message only needs its changed part converted.
+            conversion = await self._conversionPool.processIncremental(message.content, None, self._context)
+            processedMessage = conversion.result if conversion is not None else None
+            if conversion is not None:
+                self._editTracker.track(message.id, conversion)
+        else:
+            processedMessage = await self._conversionPool.process(message.content, self._context)
+        if metrics is not None:
+            lapTime = metrics.lap("conversion", lapTime)
+        if processedMessage is not None:
+            correctionText = getCorrectionText(message, processedMessage)
+            if metrics is not None:
+                metrics.lap("filter", lapTime)
+            # Sent by the scheduler, which merges bursts of corrections and keeps to the rate limits.
+            self._replyScheduler.schedule(message.channel, correctionText, message.id)
+
+    async def onMessageEdit(self, before, after):
+        '''Corrects a recently sent message again when it is edited, by editing the earlier correction.'''
+        if self._editTracker is None or before.content == after.content or not self._guildSettings.shouldCorrect(after):
+            return
+        tracked = self._editTracker.get(after.id)
+        if tracked is None:
+            return
+        conversion = await self._conversionPool.processIncremental(after.content, tracked.conversion, self._context)
+        if conversion is None:
+            return
+        tracked = self._editTracker.track(after.id, conversion)
+        correctionText = getCorrectionText(after, conversion.result) if conversion.result is not None else None
+        await self.updateCorrection(after.channel, after.id, tracked, correctionText)
+
+    async def updateCorrection(self, channel, messageId, tracked, correctionText):
+        '''Replaces the correction of a message with correctionText, or removes it when that is None.
+        Edits are rare, so they are made right away instead of through the reply scheduler.'''
+        reply = tracked.reply
+        if reply is None or reply.id is None:
+            # Not sent yet, or the reply was deleted: the correction is (re)scheduled.
+            if not self._replyScheduler.replace(channel, messageId, correctionText) and correctionText is not None:
+                self._replyScheduler.schedule(channel, correctionText, messageId)
+            return
+        reply.pieces[tracked.index] = correctionText
+        replyText = reply.getText()
+        try:
+            if replyText:
+                await channel.get_partial_message(reply.id).edit(content=replyText)
+            else:
+                await channel.get_partial_message(reply.id).delete()
+                reply.id = None
+        except Exception as error:
+            print('[{}] Failed to update a correction: {!r}'.format(datetime.now(), error))
+
+    def onMessageDelete(self, message):
+        if self._editTracker is not None:
+            self._editTracker.forget(message.id)
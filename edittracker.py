@@ -0,0 +1,86 @@
+'''Remembers the conversions of recent messages and the replies that hold their corrections, so the
+bot can correct a message again when it is edited, by editing its earlier reply.'''
+
+from collections import OrderedDict
+
+
+class Reply:
+    '''A reply of the bot, with the corrections it holds. The reply scheduler can merge the
+    corrections of several messages into one reply, so each message knows its index in pieces.'''
+
+    __slots__ = ("id", "pieces")
+
+    def __init__(self, replyId, pieces):
+        self.id = replyId
+        self.pieces = list(pieces)
+
+    def getText(self, separator="\n"):
+        '''Returns the text of the reply, without the corrections that were removed (set to None).'''
+        return separator.join(piece for piece in self.pieces if piece is not None)
+
+
+class TrackedMessage:
+    __slots__ = ("conversion", "reply", "index")
+
+    def __init__(self, conversion):
+        # The unitconversion.Conversion of the current text of the message.
+        self.conversion = conversion
+        self.reply = None
+        self.index = None
+
+
+class EditTracker:
+    '''Bounded map from message IDs to their conversion and the reply with their correction.
+
+    Holds at most maxEntries messages. The message that was sent or edited longest ago is forgotten
+    first, so the memory use stays flat on long running instances; edits of forgotten messages are
+    not corrected anymore.
+    '''
+
+    def __init__(self, maxEntries=1024):
+        self._maxEntries = maxEntries
+        self._messages = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def get(self, messageId):
+        '''Returns the TrackedMessage of messageId, or None when it is not tracked (anymore).'''
+        tracked = self._messages.get(messageId)
+        if tracked is not None:
+            self._messages.move_to_end(messageId)
+        return tracked
+
+    def track(self, messageId, conversion):
+        '''Tracks a message with its latest conversion, keeping the reply it already has. Returns its TrackedMessage.'''
+        tracked = self._messages.get(messageId)
+        if tracked is None:
+            tracked = self._messages[messageId] = TrackedMessage(conversion)
+            while len(self._messages) > self._maxEntries:
+                self._messages.popitem(last=False)
+                self.evictions += 1
+        else:
+            tracked.conversion = conversion
+            self._messages.move_to_end(messageId)
+        return tracked
+
+    def setReply(self, messageIds, replyId, pieces):
+        '''Records that the reply replyId was sent with the corrections pieces of the messages messageIds.'''
+        reply = Reply(replyId, pieces)
+        for index, messageId in enumerate(messageIds):
+            tracked = self._messages.get(messageId)
+            if tracked is not None:
+                tracked.reply = reply
+                tracked.index = index
+        return reply
+
+    def replySent(self, channel, sent, messageIds, pieces):
+        '''The onSent callback of replyscheduler.ReplyScheduler, sent is the message that was sent.'''
+        self.setReply(messageIds, sent.id, pieces)
+
+    def forget(self, messageId):
+        self._messages.pop(messageId, None)
+
+    def getStats(self):
+        return {"messages": len(self._messages), "evictions": self.evictions}
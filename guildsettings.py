@@ -0,0 +1,111 @@
+'''Decides per message whether the bot corrects it: opt-out role, and guilds and channels that opted out.'''
+
+import json
+import os
+
+OPT_OUT_ROLE = 'imperial certified'    # Members with a role of this name are never corrected.
+
+
+class GuildSettings:
+    '''Keeps, per guild, the IDs of the roles named OPT_OUT_ROLE, and the guilds and channels that opted out.
+
+    The roles of a guild are scanned once, the first time a message of that guild is checked, and
+    afterwards kept current from the role events, so checking a message never scans the guild roles.
+    The opt-outs are saved to a JSON file, when a path is given. The processes of launcher.py share
+    this file; each only needs the opt-outs of its own guilds, which are in its own shards.
+    '''
+
+    def __init__(self, path=None, optOutRole=OPT_OUT_ROLE):
+        self._path = path
+        self._optOutRole = optOutRole
+        self._optOutRoles = {}
+        self._disabledGuilds = set()
+        self._disabledChannels = set()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def _read(self):
+        '''Returns the opt-outs saved in the file, as (disabled guilds, disabled channels).'''
+        if not os.path.exists(self._path):
+            return set(), set()
+        with open(self._path, 'r', encoding='utf-8') as settingsFile:
+            settings = json.load(settingsFile)
+        return set(settings.get('disabledGuilds', [])), set(settings.get('disabledChannels', []))
+
+    def load(self):
+        self._disabledGuilds, self._disabledChannels = self._read()
+
+    def _save(self, guildId=None, channelId=None, enabled=True):
+        '''Saves one change to the file. Every process of launcher.py has its own GuildSettings, so the
+        file is read again and only this change is applied, keeping what the other processes saved.'''
+        if self._path is None:
+            return
+        disabledGuilds, disabledChannels = self._read()
+        for disabled, itemId in ((disabledGuilds, guildId), (disabledChannels, channelId)):
+            if itemId is None:
+                continue
+            if enabled:
+                disabled.discard(itemId)
+            else:
+                disabled.add(itemId)
+        # A temporary file per process, so processes that save at the same time do not write into the same file.
+        temporaryPath = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(temporaryPath, 'w', encoding='utf-8') as settingsFile:
+            json.dump({'disabledGuilds': sorted(disabledGuilds), 'disabledChannels': sorted(disabledChannels)}, settingsFile, indent=2)
+        os.replace(temporaryPath, self._path)
+
+    def getOptOutRoles(self, guild):
+        roles = self._optOutRoles.get(guild.id)
+        if roles is None:
+            roles = self._optOutRoles[guild.id] = {role.id for role in guild.roles if role.name == self._optOutRole}
+        return roles
+
+    # Role events. Guilds that have not been scanned yet are left alone, they are scanned when needed.
+    def updateRole(self, role):
+        roles = self._optOutRoles.get(role.guild.id)
+        if roles is None:
+            return
+        if role.name == self._optOutRole:
+            roles.add(role.id)
+        else:
+            roles.discard(role.id)
+
+    def removeRole(self, role):
+        roles = self._optOutRoles.get(role.guild.id)
+        if roles is not None:
+            roles.discard(role.id)
+
+    def forgetGuild(self, guild):
+        self._optOutRoles.pop(guild.id, None)
+
+    def setGuildEnabled(self, guild, enabled):
+        if enabled:
+            self._disabledGuilds.discard(guild.id)
+        else:
+            self._disabledGuilds.add(guild.id)
+        self._save(guildId=guild.id, enabled=enabled)
+
+    def setChannelEnabled(self, channel, enabled):
+        if enabled:
+            self._disabledChannels.discard(channel.id)
+        else:
+            self._disabledChannels.add(channel.id)
+        self._save(channelId=channel.id, enabled=enabled)
+
+    def isGuildEnabled(self, guild):
+        return guild.id not in self._disabledGuilds
+
+    def isChannelEnabled(self, channel):
+        return channel.id not in self._disabledChannels
+
+    def shouldCorrect(self, message):
+        '''Returns whether the message may be corrected. Direct messages always may.'''
+        if message.guild is None:
+            return True
+        if message.guild.id in self._disabledGuilds or message.channel.id in self._disabledChannels:
+            return False
+        roles = self.getOptOutRoles(message.guild)
+        if not roles:
+            return True
+        # Webhook messages have a user without roles as author.
+        return not any(role.id in roles for role in getattr(message.author, 'roles', ()))
@@ -0,0 +1,224 @@
+'''Instrumentation of the message path: latency histograms per stage, counters, an HTTP endpoint in
+the Prometheus text format and a sampling profiler that can be switched on and off at runtime.'''
+
+import io
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds, from a pre-filtered message (microseconds) up to a slow Discord send.
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    '''Counts observations per bucket, like a Prometheus histogram. Not thread safe on its own.'''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self._counts[bisect_left(self._bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def getBuckets(self):
+        '''Returns (upper bound, cumulative count) pairs, ending with an infinite bound.'''
+        buckets = []
+        total = 0
+        for bound, count in zip(self._bounds + (float("inf"),), self._counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def getQuantile(self, fraction):
+        '''Returns the upper bound of the bucket that holds the given fraction of the observations, or None.'''
+        if self.count == 0:
+            return
+        rank = fraction * self.count
+        for bound, total in self.getBuckets():
+            if total >= rank:
+                return bound
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _formatBound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class Metrics:
+    '''Thread safe collection of stage latencies, message outcomes and hits per unit.'''
+
+    def __init__(self, prefix="unitcorrector", buckets=DEFAULT_BUCKETS):
+        self._prefix = prefix
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._outcomes = {}
+        self._unitHits = {}
+        self._gauges = []
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self._buckets)
+            histogram.observe(seconds)
+
+    def lap(self, stage, since):
+        '''Observes the time from since until now for stage, and returns now.'''
+        now = time.perf_counter()
+        self.observe(stage, now - since)
+        return now
+
+    def countOutcome(self, outcome):
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+
+    def countUnit(self, unitName):
+        with self._lock:
+            self._unitHits[unitName] = self._unitHits.get(unitName, 0) + 1
+
+    def addGauges(self, function):
+        '''Adds a function returning a dict of gauge names and values, which is called on every render.'''
+        self._gauges.append(function)
+
+    def getStageStats(self):
+        '''Returns a dict of stage to (count, total seconds, p50, p99), where the percentiles are bucket bounds.'''
+        with self._lock:
+            return {stage: (histogram.count, histogram.sum, histogram.getQuantile(0.5), histogram.getQuantile(0.99))
+                    for stage, histogram in self._stages.items()}
+
+    def getOutcomes(self):
+        with self._lock:
+            return dict(self._outcomes)
+
+    def getUnitHits(self):
+        with self._lock:
+            return dict(self._unitHits)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._outcomes.clear()
+            self._unitHits.clear()
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text exposition format.'''
+        prefix = self._prefix
+        lines = []
+        with self._lock:
+            lines.append("# HELP {}_stage_seconds Time spent per stage of the message path.".format(prefix))
+            lines.append("# TYPE {}_stage_seconds histogram".format(prefix))
+            for stage, histogram in sorted(self._stages.items()):
+                for bound, total in histogram.getBuckets():
+                    lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, _escape(stage), _formatBound(bound), total))
+                lines.append('{}_stage_seconds_sum{{stage="{}"}} {!r}'.format(prefix, _escape(stage), histogram.sum))
+                lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, _escape(stage), histogram.count))
+            lines.append("# HELP {}_messages_total Messages by outcome of their conversion.".format(prefix))
+            lines.append("# TYPE {}_messages_total counter".format(prefix))
+            for outcome, count in sorted(self._outcomes.items()):
+                lines.append('{}_messages_total{{outcome="{}"}} {}'.format(prefix, _escape(outcome), count))
+            lines.append("# HELP {}_unit_hits_total Conversions by unit.".format(prefix))
+            lines.append("# TYPE {}_unit_hits_total counter".format(prefix))
+            for unitName, count in sorted(self._unitHits.items()):
+                lines.append('{}_unit_hits_total{{unit="{}"}} {}'.format(prefix, _escape(unitName), count))
+        for function in self._gauges:
+            for name, value in sorted(function().items()):
+                lines.append("# TYPE {}_{} gauge".format(prefix, name))
+                lines.append("{}_{} {}".format(prefix, name, float(value)))
+        return "\n".join(lines) + "\n"
+
+
+def startServer(metrics, port, host="127.0.0.1"):
+    '''Serves metrics.render() on http://host:port/metrics from a daemon thread. Returns the server.'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def _newProfile():
+    '''Returns a profile that only records the thread it runs in. From Python 3.12 on, cProfile uses
+    sys.monitoring, which records every thread: the other workers and the event loop would end up in
+    the sample, recorded from several threads into a profile that is not thread safe. The profile
+    module (slower, but only for the sampled calls) still uses sys.setprofile, which is per thread.'''
+    if sys.version_info >= (3, 12):
+        import profile
+        return profile.Profile()
+    import cProfile
+    return cProfile.Profile()
+
+
+class SamplingProfiler:
+    '''Runs a random sample of calls under a profiler, to find hot paths under live load.
+
+    Only one sampled call is profiled at a time, and only the thread that runs it is recorded; calls
+    made while another one is being profiled run normally, so the profiler never makes conversions
+    wait on each other.
+    '''
+
+    def __init__(self):
+        self._profile = None
+        self._sampleRate = 0.0
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    def isActive(self):
+        return self._profile is not None
+
+    def start(self, sampleRate=0.1):
+        self._sampleRate = sampleRate
+        self.samples = 0
+        self._profile = _newProfile()
+
+    def stop(self, limit=20):
+        '''Stops profiling and returns the functions with the most cumulative time, as text.'''
+        import pstats
+
+        profile = self._profile
+        self._profile = None
+        if profile is None:
+            return ""
+        # Waits for a sampled call that is still running.
+        with self._lock:
+            if self.samples == 0:
+                return ""
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).strip_dirs().sort_stats("cumulative").print_stats(limit)
+            return stream.getvalue()
+
+    def run(self, function, *args):
+        profile = self._profile
+        if profile is None or random.random() >= self._sampleRate or not self._lock.acquire(blocking=False):
+            return function(*args)
+        try:
+            self.samples += 1
+            return profile.runcall(function, *args)
+        finally:
+            self._lock.release()
@@ -0,0 +1,128 @@
+# Runs the Discord Unit Corrector Bot on several processes, for large deployments.
+#
+# Every process runs its own range of the shards, with its own conversion workers, and restarts
+# when it crashes. The statistics of all processes are collected, so !stats shows their totals.
+#
+# To run the bot on 4 processes with 16 shards in total:
+# python launcher.py --processes 4 --shards 16
+#
+# Licenced under: MIT License, Copyright (c) 2018 Wendelstein7 and ficolas2
+
+import multiprocessing
+import signal
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+RESTART_DELAY = 5.0    # Option: Seconds before a crashed process is started again, doubled on every crash in a row. DEFAULT: 5.0
+MAX_RESTART_DELAY = 300.0    # Option: Longest wait before starting a crashed process again. DEFAULT: 300.0
+STABLE_TIME = 600.0    # Option: Seconds a process has to run before its restart delay is reset. DEFAULT: 600.0
+
+
+# Splits the shards 0 .. shardCount - 1 into contiguous ranges, one per process.
+def shardRanges(shardCount, processes):
+    return [list(range(index * shardCount // processes, (index + 1) * shardCount // processes)) for index in range(processes)]
+
+
+# Sums the numbers in the statistics of all processes.
+def aggregateStats(stats):
+    totals = {}
+    for processStats in stats.values():
+        for name, value in processStats.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def runShards(shardIds, shardCount, stats, processIndex):
+    # Imported in the process itself, so the launcher does not need discord or the bot.
+    import unitbot
+    unitbot.main(shardIds=shardIds, shardCount=shardCount, stats=stats, index=processIndex)
+
+
+class Launcher:
+    '''Starts one process per shard range and starts crashed processes again, with a growing delay.'''
+
+    def __init__(self, processes, shardCount, target=runShards, startMethod='spawn'):
+        if shardCount < processes:
+            raise ValueError('Every process needs at least one shard, use at least {} shards'.format(processes))
+        self._context = multiprocessing.get_context(startMethod)
+        self._manager = self._context.Manager()
+        self._ranges = shardRanges(shardCount, processes)
+        self._shardCount = shardCount
+        self._target = target
+        self._processes = [None] * processes
+        self._startTimes = [0.0] * processes
+        self._restartDelays = [RESTART_DELAY] * processes
+        self._restartTimes = [None] * processes
+        self._stopping = False
+        # Shared with the processes, every process keeps its latest statistics under its index.
+        self.stats = self._manager.dict()
+        self.restarts = 0
+
+    def _start(self, index):
+        process = self._context.Process(target=self._target, args=(self._ranges[index], self._shardCount, self.stats, index),
+                                        name='shards-{}-{}'.format(self._ranges[index][0], self._ranges[index][-1]))
+        process.start()
+        self._processes[index] = process
+        self._startTimes[index] = time.monotonic()
+        self._restartTimes[index] = None
+
+    def start(self):
+        for index in range(len(self._processes)):
+            self._start(index)
+
+    # Checks the processes once, starting the ones that crashed (again) once their delay has passed.
+    def poll(self):
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if self._stopping or process.is_alive():
+                continue
+            if self._restartTimes[index] is None:
+                if now - self._startTimes[index] >= STABLE_TIME:
+                    self._restartDelays[index] = RESTART_DELAY
+                print('[{}] Process {} (shards {}) exited with code {}, restarting in {:.0f} s'.format(
+                    datetime.now(), process.name, self._ranges[index], process.exitcode, self._restartDelays[index]))
+                self.stats.pop(index, None)
+                self._restartTimes[index] = now + self._restartDelays[index]
+                self._restartDelays[index] = min(self._restartDelays[index] * 2, MAX_RESTART_DELAY)
+            elif now >= self._restartTimes[index]:
+                self.restarts += 1
+                self._start(index)
+
+    def run(self, pollInterval=1.0):
+        self.start()
+        while not self._stopping:
+            self.poll()
+            time.sleep(pollInterval)
+
+    # Makes run return, can be called from a signal handler.
+    def requestStop(self):
+        self._stopping = True
+
+    def stop(self):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+        self._manager.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=multiprocessing.cpu_count(), help='Number of bot processes')
+    parser.add_argument('-s', '--shards', dest='shards', type=int, help='Total number of shards, at least the number of processes. DEFAULT: the number of processes')
+    args = parser.parse_args()
+
+    shardCount = max(args.shards or args.processes, args.processes)
+    launcher = Launcher(args.processes, shardCount)
+
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: launcher.requestStop())
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        launcher.stop()
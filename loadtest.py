@@ -0,0 +1,275 @@
+# Offline load test of the bot: feeds messages to its on_message handler without connecting to Discord.
+#
+# To replay a synthetic stream of 200 messages per second for 10 seconds:
+# python loadtest.py --rate 200 --duration 10
+#
+# To replay recorded messages, one JSON object per line with "content" and optionally "guild",
+# "channel", "author" (IDs) and "certified" (whether the author has the opt-out role):
+# python loadtest.py --replay messages.jsonl --rate 100
+#
+# To find the highest rate at which latency and event loop lag stay within bounds:
+# python loadtest.py --find-max
+
+import asyncio
+import json
+import random
+import time
+import zlib
+from argparse import ArgumentParser
+from itertools import count
+
+import benchmark
+import guildsettings
+
+_ids = count(1000)
+
+
+class FakeUser:
+    def __init__(self, name, bot=False, roles=None):
+        self.id = next(_ids)
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.roles = roles if roles is not None else []
+        self.mention = '<@{}>'.format(self.id)
+
+
+class FakeRole:
+    def __init__(self, name, guild):
+        self.id = next(_ids)
+        self.name = name
+        self.guild = guild
+
+
+class FakeGuild:
+    '''A guild with roleCount roles, one of which is the opt-out role.'''
+
+    def __init__(self, name, roleCount=50):
+        self.id = next(_ids)
+        self.name = name
+        self.roles = [FakeRole('role {}'.format(index), self) for index in range(roleCount - 1)]
+        self.optOutRole = FakeRole(guildsettings.OPT_OUT_ROLE, self)
+        self.roles.insert(roleCount // 2, self.optOutRole)
+
+
+class FakePermissions:
+    manage_guild = True
+    manage_channels = True
+
+
+class FakePartialMessage:
+    def __init__(self, channel, messageId):
+        self.channel = channel
+        self.id = messageId
+
+    async def edit(self, content=None):
+        self.channel.edited.append((self.id, content))
+
+    async def delete(self):
+        self.channel.deleted.append(self.id)
+
+
+class FakeChannel:
+    '''Records what the bot sends to it, optionally taking sendLatency seconds like a real API call,
+    and the messages it edits and deletes.'''
+
+    def __init__(self, name, guild=None, sendLatency=0.0):
+        self.id = next(_ids)
+        self.name = name
+        self.guild = guild
+        self.sendLatency = sendLatency
+        self.sent = []
+        self.edited = []
+        self.deleted = []
+
+    async def send(self, content=None, embed=None):
+        if self.sendLatency:
+            await asyncio.sleep(self.sendLatency)
+        self.sent.append((time.perf_counter(), content))
+        return FakeMessage(content, FakeUser('UnitCorrector', bot=True), self)
+
+    def get_partial_message(self, messageId):
+        return FakePartialMessage(self, messageId)
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        # The connection state, which the command handling of discord.py copies into its context.
+        self._state = None
+
+
+class LoadTestResult:
+    def __init__(self, dispatched, elapsed, latencies, lags):
+        self.dispatched = dispatched
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+        self.lags = sorted(lags)
+
+    def getMessagesPerSecond(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def getLatency(self, fraction):
+        return benchmark.percentile(self.latencies, fraction) if self.latencies else 0.0
+
+    def getMaxLag(self):
+        return self.lags[-1] if self.lags else 0.0
+
+    def format(self):
+        return '{:6d} messages in {:6.2f} s: {:8.0f} messages/s, latency p50 {:7.2f} ms, p99 {:7.2f} ms, max event loop lag {:7.2f} ms'.format(
+            self.dispatched, self.elapsed, self.getMessagesPerSecond(), self.getLatency(0.5) * 1000, self.getLatency(0.99) * 1000, self.getMaxLag() * 1000)
+
+
+async def _monitorLag(lags, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def _handle(handler, message, latencies):
+    start = time.perf_counter()
+    await handler(message)
+    latencies.append(time.perf_counter() - start)
+
+
+async def replay(handler, messages, rate=None, lagInterval=0.01):
+    '''Feeds every message to the handler coroutine in its own task, like discord.py dispatches events,
+    at rate messages per second (None is as fast as possible). Measures the time each handler call
+    takes and how late the event loop runs a timer that should fire every lagInterval seconds.'''
+    loop = asyncio.get_running_loop()
+    latencies = []
+    lags = []
+    monitor = asyncio.ensure_future(_monitorLag(lags, lagInterval))
+    tasks = []
+    start = loop.time()
+    for index, message in enumerate(messages):
+        delay = start + index / rate - loop.time() if rate else 0
+        # Also yields now and then at full speed, so handlers start while messages are dispatched.
+        if delay > 0 or index % 64 == 0:
+            await asyncio.sleep(max(delay, 0))
+        tasks.append(asyncio.ensure_future(_handle(handler, message, latencies)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+    monitor.cancel()
+    return LoadTestResult(len(tasks), elapsed, latencies, lags)
+
+
+async def findMaxRate(handler, makeMessages, rates, maxLatency=0.25, maxLag=0.05):
+    '''Replays makeMessages(rate) at each of the increasing rates, and returns the highest rate at
+    which the p99 latency and the event loop lag stay within bounds and the handler keeps up, with
+    the results of all rates that were tried.'''
+    best = None
+    results = []
+    for rate in rates:
+        result = await replay(handler, makeMessages(rate), rate)
+        results.append((rate, result))
+        if result.getLatency(0.99) > maxLatency or result.getMaxLag() > maxLag or result.getMessagesPerSecond() < 0.9 * rate:
+            break
+        best = rate
+    return best, results
+
+
+# Maps a recorded ID onto one of count synthetic ones, the same way in every run.
+def _pick(recordedId, count):
+    return zlib.crc32(str(recordedId).encode('utf-8')) % count
+
+
+class SyntheticServer:
+    '''Guilds, channels and members to send synthetic or recorded messages from. A fraction of the
+    members has the opt-out role, and a fraction of the messages comes in direct messages.'''
+
+    def __init__(self, guilds=5, channelsPerGuild=4, membersPerGuild=50, roleCount=200, certifiedFraction=0.1, sendLatency=0.0, seed=0):
+        self._rng = random.Random(seed)
+        self.guilds = [FakeGuild('guild {}'.format(index), roleCount) for index in range(guilds)]
+        self.channels = []
+        self.members = {}
+        for guild in self.guilds:
+            self.channels.extend(FakeChannel('channel {}'.format(index), guild, sendLatency) for index in range(channelsPerGuild))
+            self.members[guild.id] = [FakeUser('member {}'.format(index), roles=[guild.roles[0]]) for index in range(membersPerGuild)]
+            for member in self._rng.sample(self.members[guild.id], int(membersPerGuild * certifiedFraction)):
+                member.roles.append(guild.optOutRole)
+        self.directChannel = FakeChannel('direct messages', None, sendLatency)
+        self.directUser = FakeUser('direct user')
+
+    def getSent(self):
+        return [sent for channel in self.channels + [self.directChannel] for sent in channel.sent]
+
+    def makeMessage(self, content, directFraction=0.05):
+        if self._rng.random() < directFraction:
+            return FakeMessage(content, self.directUser, self.directChannel)
+        channel = self._rng.choice(self.channels)
+        return FakeMessage(content, self._rng.choice(self.members[channel.guild.id]), channel)
+
+    def makeRecordedMessage(self, record):
+        '''Builds a message from a recorded one. The guild, channel and author IDs are mapped onto the synthetic ones.'''
+        if record.get('guild') is None:
+            return FakeMessage(record['content'], self.directUser, self.directChannel)
+        guild = self.guilds[_pick(record['guild'], len(self.guilds))]
+        channels = [channel for channel in self.channels if channel.guild is guild]
+        channel = channels[_pick(record.get('channel'), len(channels))]
+        members = self.members[guild.id]
+        author = members[_pick(record.get('author'), len(members))]
+        if record.get('certified') is not None:
+            author = FakeUser(author.name, roles=[guild.roles[0], guild.optOutRole] if record['certified'] else [guild.roles[0]])
+        return FakeMessage(record['content'], author, channel)
+
+    def syntheticMessages(self, count, seed=0):
+        corpus = benchmark.build_corpus(seed, max(10, count // 3))
+        contents = corpus['chatter'] + corpus['single'] + corpus['code'] + corpus['dense']
+        self._rng.shuffle(contents)
+        return [self.makeMessage(contents[index % len(contents)]) for index in range(count)]
+
+
+def printReport(server, result, dropped):
+    print('  ' + result.format())
+    print('  {} replies sent, {} conversions dropped by the worker pool'.format(len(server.getSent()), dropped))
+
+
+async def main(args):
+    # Imported here, as the bot needs discord.py. Nothing is started at import, see unitbot.main.
+    import unitbot
+
+    server = SyntheticServer(sendLatency=args.sendLatency, seed=args.seed)
+    # The user the bot would be logged in as, which on_message and the command handling look at.
+    unitbot.bot._connection.user = FakeUser('UnitCorrector', bot=True)
+
+    if args.findMax:
+        best, results = await findMaxRate(unitbot.on_message, lambda rate: server.syntheticMessages(int(rate * args.duration), args.seed),
+                                          [50, 100, 200, 400, 800, 1600, 3200, 6400])
+        for rate, result in results:
+            print('  {:5d} messages/s offered: {}'.format(rate, result.format()))
+        print('Max sustainable rate: {} messages/s'.format(best))
+        return
+
+    if args.replay:
+        with open(args.replay, 'r', encoding='utf-8') as replayFile:
+            messages = [server.makeRecordedMessage(json.loads(line)) for line in replayFile if line.strip()]
+    else:
+        messages = server.syntheticMessages(args.count or int(args.rate * args.duration), args.seed)
+    droppedBefore = unitbot.conversionPool.dropped
+    result = await replay(unitbot.on_message, messages, args.rate or None)
+    # Waits for the reply scheduler to send what is still queued.
+    while unitbot.replyScheduler.getQueueDepth():
+        await asyncio.sleep(0.05)
+    printReport(server, result, unitbot.conversionPool.dropped - droppedBefore)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--rate', dest='rate', type=float, default=200, help='Messages per second, 0 is as fast as possible')
+    parser.add_argument('--duration', dest='duration', type=float, default=10, help='Seconds of synthetic messages')
+    parser.add_argument('--count', dest='count', type=int, help='Number of synthetic messages, instead of rate times duration')
+    parser.add_argument('--replay', dest='replay', help='Replay recorded messages from this JSONL file')
+    parser.add_argument('--find-max', dest='findMax', action='store_true', help='Find the max sustainable messages/s')
+    parser.add_argument('--send-latency', dest='sendLatency', type=float, default=0.05, help='Seconds a simulated send takes')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the synthetic messages')
+    asyncio.run(main(parser.parse_args()))
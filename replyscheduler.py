@@ -0,0 +1,166 @@
+'''Schedules the replies of the bot per channel, within the rate limits of Discord.'''
+
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+
+
+class _ChannelQueue:
+    __slots__ = ("channel", "replies", "sendTimes", "wakeup", "task")
+
+    def __init__(self, channel, rate):
+        self.channel = channel
+        self.replies = deque()
+        # The times of the last sends, to know when the rate limit allows the next one.
+        self.sendTimes = deque(maxlen=rate)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+
+def _delay(sendTimes, per, now):
+    '''Returns how long to wait before a send, when sendTimes holds the last (rate) sends.'''
+    while sendTimes and sendTimes[0] + per <= now:
+        sendTimes.popleft()
+    if len(sendTimes) < sendTimes.maxlen:
+        return 0
+    return sendTimes[0] + per - now
+
+
+class ReplyScheduler:
+    '''Queues replies per channel and sends them without running into the rate limits of Discord.
+
+    Every channel gets its own sender task, which sends at most rate messages per per seconds (the
+    per channel limit of Discord is 5 messages per 5 seconds), and all channels together at most
+    globalRate per globalPer seconds. The limits are kept ahead of time, so the bot does not wait
+    on 429 responses, and a busy channel only ever waits on its own limit. Replies that queue up
+    while a channel waits are merged into one message, as long as it stays within maxLength.
+    Replies that could not be sent within maxAge seconds are dropped, as are the oldest replies of
+    a channel with more than maxQueue waiting. Must be used from within the running event loop.
+
+    A reply can be scheduled with a key, to replace it while it waits. After every send, onSent (when
+    given) is called with the channel, the result of send, and the keys and texts of the replies in it.
+    '''
+
+    def __init__(self, send, rate=5, per=5.0, maxAge=10.0, maxQueue=20, maxLength=2000, separator="\n", globalRate=50, globalPer=1.0, onSent=None):
+        self._send = send
+        self._onSent = onSent
+        self._rate = rate
+        self._per = per
+        self._maxAge = maxAge
+        self._maxQueue = maxQueue
+        self._maxLength = maxLength
+        self._separator = separator
+        self._globalPer = globalPer
+        self._globalSendTimes = deque(maxlen=globalRate)
+        self._channels = {}
+        self.scheduled = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def getQueueDepth(self):
+        return sum(len(queue.replies) for queue in self._channels.values())
+
+    def getStats(self):
+        return {
+            "channels": len(self._channels),
+            "queued": self.getQueueDepth(),
+            "scheduled": self.scheduled,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "stale": self.stale,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def schedule(self, channel, text, key=None):
+        '''Queues text to be sent to channel, which is passed to the send function as is.'''
+        queue = self._channels.get(channel)
+        if queue is None:
+            queue = self._channels[channel] = _ChannelQueue(channel, self._rate)
+        if len(queue.replies) >= self._maxQueue:
+            queue.replies.popleft()
+            self.dropped += 1
+        queue.replies.append((text, time.monotonic() + self._maxAge, key))
+        self.scheduled += 1
+        queue.wakeup.set()
+        if queue.task is None:
+            queue.task = asyncio.ensure_future(self._run(queue))
+
+    def replace(self, channel, key, text):
+        '''Replaces the text of the waiting reply with key, or removes it when text is None. Returns
+        whether such a reply was waiting.'''
+        queue = self._channels.get(channel)
+        if queue is None:
+            return False
+        for index, (oldText, expires, replyKey) in enumerate(queue.replies):
+            if replyKey == key:
+                if text is None:
+                    del queue.replies[index]
+                else:
+                    queue.replies[index] = (text, expires, key)
+                return True
+        return False
+
+    def _takeReplies(self, queue, now):
+        '''Removes the replies that are sent next from the queue, and returns them, or None.'''
+        while queue.replies and queue.replies[0][1] < now:
+            queue.replies.popleft()
+            self.stale += 1
+        if not queue.replies:
+            return
+        replies = [queue.replies.popleft()]
+        length = len(replies[0][0])
+        while queue.replies and length + len(self._separator) + len(queue.replies[0][0]) <= self._maxLength:
+            if queue.replies[0][1] >= now:
+                replies.append(queue.replies[0])
+                length += len(self._separator) + len(replies[-1][0])
+                self.coalesced += 1
+            else:
+                self.stale += 1
+            queue.replies.popleft()
+        return replies
+
+    async def _run(self, queue):
+        try:
+            while True:
+                now = time.monotonic()
+                delay = _delay(queue.sendTimes, self._per, now)
+                if not queue.replies:
+                    if not queue.sendTimes:
+                        # Nothing left to send and no rate limit to remember.
+                        return
+                    queue.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(queue.wakeup.wait(), queue.sendTimes[0] + self._per - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                delay = max(delay, _delay(self._globalSendTimes, self._globalPer, now))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                replies = self._takeReplies(queue, now)
+                if replies is None:
+                    continue
+                texts = [reply[0] for reply in replies]
+                queue.sendTimes.append(now)
+                self._globalSendTimes.append(now)
+                try:
+                    sent = await self._send(queue.channel, self._separator.join(texts))
+                    self.sent += 1
+                except Exception as error:
+                    self.failed += 1
+                    print('[{}] Failed to send a reply: {!r}'.format(datetime.now(), error))
+                    continue
+                if self._onSent is not None:
+                    self._onSent(queue.channel, sent, [reply[2] for reply in replies], texts)
+        finally:
+            del self._channels[queue.channel]
+
+    def close(self):
+        for queue in list(self._channels.values()):
+            queue.task.cancel()
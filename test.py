@@ -5,9 +5,34 @@
 # python test.py -v
 
 import unittest
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.request import urlopen
 
+import conversionpool
+import convert
+import corrector
+import edittracker
+import guildsettings
+import instrumentation
+import launcher
+import loadtest
+import replyscheduler
 import unitconversion
+import unitpediaindex
+import unitpedialib
 
 parser = ArgumentParser()
 parser.add_argument("-m", "--message", dest="message", help="Message to convert")
@@ -22,6 +47,15 @@ if message:
     print(conversion_result)
 
 
+# Stand-in for the bot in launcher tests: the first start of every process crashes, later ones keep running.
+def crashOnce(shardIds, shardCount, stats, processIndex):
+    starts = stats.get(("starts", processIndex), 0) + 1
+    stats[("starts", processIndex)] = starts
+    stats[processIndex] = {"shards": len(shardIds)}
+    if starts == 1:
+        raise SystemExit(1)
+    time.sleep(60)
+
 class TestUnitCorrection(unittest.TestCase):
     def test_base_unit_conversion(self):
         unit_pairs = [
@@ -90,6 +124,768 @@ class TestUnitCorrection(unittest.TestCase):
             result = unitconversion.process(raw_unit)
             self.assertEqual(result, expected_unit)
 
+    def test_unit_precedence(self):
+        unit_pairs = [
+            ["5 troy ounces", "156 g"],
+            ["5 ounces", "142 g"],
+            ["5 ft lbf", "6.78 J"],
+            ["5 ft", "1.52 m"],
+            ["5 lbf ft", "22.2 N ft"],
+            ["3 nautical miles", "5.56 km"],
+            ["3 miles", "4.83 km"],
+            ["2 ft 3 in tall", "0.61 m 3 in tall"],
+            ["0 ft lbf", None],
+            ["a 1st place", None],
+            ["10 fl oz", "296 mL"]
+        ]
+
+        for pair in unit_pairs:
+            raw_unit = pair[0]
+            expected_unit = pair[1]
+            result = unitconversion.process(raw_unit)
+            self.assertEqual(result, expected_unit)
+
+    def test_prefilter(self):
+        rejected = unitconversion.prefilterStats["rejected"]
+        for raw in ["no numbers here", "12345", "year 2020", ""]:
+            self.assertIsNone(unitconversion.process(raw))
+        self.assertEqual(unitconversion.prefilterStats["rejected"], rejected + 4)
+        self.assertTrue(unitconversion.mayContainUnits("I have 5 cats"))
+        self.assertTrue(unitconversion.mayContainUnits("5`code`ft"))
+        self.assertEqual(unitconversion.process("5 `code` ft"), "1.52  m")
+
+    def test_long_dense_message(self):
+        chunk = "width 12 ft, depth 3 in, weight 150 lbs, 5 gallons at 70 °F, 10 mph and 2 miles. "
+        repeats = 4000 // len(chunk)
+        result = unitconversion.process(chunk * repeats)
+        self.assertEqual(result, unitconversion.process(chunk) * repeats)
+
+    def test_unit_type_multiples(self):
+        value_pairs = [
+            [500, "500 m"],
+            [501, "0.501 km"],
+            [0.005, "5 mm"],
+            [0.0051, "0.51 cm"],
+            [1e-15, "0.001 pm"],
+            [0, "0 pm"],
+            [-2000, "-2 km"]
+        ]
+
+        for pair in value_pairs:
+            self.assertEqual(unitconversion.DISTANCE.getString(pair[0]), pair[1])
+        self.assertEqual(unitconversion.DISTANCE.getStringFromMultiple(1500, 10**3), "1.5 km")
+
+    def convert_values_one_by_one(self, values, units, spacings, context):
+        return [unit.toMetric(value, context.withSpacing(spacing)) for value, unit, spacing in zip(values, units, spacings)]
+
+    def random_values(self, count):
+        rng = random.Random(5)
+        values = [rng.choice([0.0, -0.0, 1.0, 0.5, 12.5, 1e-9, 2.5e12]) * rng.choice([1, -1]) if rng.random() < 0.3 else round(rng.uniform(-5000, 5000), rng.randint(0, 3))
+                  for _ in range(count)]
+        units = [rng.choice(unitconversion.units) for _ in range(count)]
+        spacings = [rng.choice(["", " ", "  "]) for _ in range(count)]
+        return values, units, spacings
+
+    def test_convert_values(self):
+        values, units, spacings = self.random_values(500)
+        for context in [unitconversion.ConversionContext(), unitconversion.ConversionContext(useSignificant=False, decimals=1)]:
+            self.assertEqual(unitconversion.convertValues(values[:10], units[:10], spacings[:10], context), self.convert_values_one_by_one(values[:10], units[:10], spacings[:10], context))
+            self.assertEqual(unitconversion.convertValues(values, units, spacings, context), self.convert_values_one_by_one(values, units, spacings, context))
+
+
+class TestConversionContext(unittest.TestCase):
+    def test_context_options(self):
+        context = unitconversion.ConversionContext(useSignificant=False, decimals=1)
+        self.assertEqual(unitconversion.process("10 feet", context), "3 m")
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.assertEqual(unitconversion.SPACED, " ")
+
+    def test_threaded_process(self):
+        significant = unitconversion.ConversionContext()
+        decimals = unitconversion.ConversionContext(useSignificant=False, decimals=1)
+        jobs = []
+        for raw in ["10 feet", "10feet", "I  am  2  feet  tall", "wow\t4\tcalories", "5 troy ounces and 3 mi"]:
+            jobs.append((raw, significant, unitconversion.process(raw, significant)))
+            jobs.append((raw, decimals, unitconversion.process(raw, decimals)))
+        jobs = jobs * 200
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda job: unitconversion.process(job[0], job[1]), jobs))
+
+        for job, result in zip(jobs, results):
+            self.assertEqual(result, job[2])
+
+
+class TestWorstCase(unittest.TestCase):
+    def test_remove_quoted_matches_regex(self):
+        rng = random.Random(0)
+        for _ in range(20000):
+            text = "".join(rng.choice("``´>a 5") for _ in range(rng.randint(0, 16)))
+            self.assertEqual(unitconversion.removeQuoted(text), unitconversion.REMOVE_REGEX.sub("", text))
+
+    def test_time_budget(self):
+        exceeded = unitconversion.budgetStats["exceeded"]
+        context = unitconversion.ConversionContext(timeBudget=1e-9)
+        self.assertIsNone(unitconversion.process("1 ft, " * 500, context))
+        self.assertEqual(unitconversion.budgetStats["exceeded"], exceeded + 1)
+        self.assertEqual(unitconversion.process("10 feet", unitconversion.ConversionContext(timeBudget=10)), "3.05 m")
+
+    def test_linear_worst_case(self):
+        # Crafted messages, as a function of their length. Quadrupling the length should about
+        # quadruple the time; a quadratic pattern would take sixteen times as long.
+        adversarial = [
+            lambda n: "`" + "a" * n,
+            lambda n: "``" + "a 5 ft " * (n // 7),
+            lambda n: ("` 5 ft >" * n)[:n],
+            lambda n: ("`´>" * n)[:n],
+            lambda n: "5" + " " * n + "ft",
+            lambda n: "5 ft" + "!" * n + "x",
+            lambda n: ("5 degree " * n)[:n],
+            lambda n: ("5 " * n)[:n] + "ft",
+            lambda n: "1" * n,
+        ]
+
+        for make in adversarial:
+            short, long = make(1000), make(4000)
+            shortTime = min(timeit.repeat(lambda: unitconversion.process(short), number=1, repeat=5))
+            longTime = min(timeit.repeat(lambda: unitconversion.process(long), number=1, repeat=5))
+            self.assertLess(longTime, 8 * shortTime + 0.001, repr(short[:20]))
+
+
+class TestResultCache(unittest.TestCase):
+    def tearDown(self):
+        unitconversion.disableCache()
+
+    def test_cache_hits(self):
+        cache = unitconversion.enableCache(maxEntries=10)
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.assertEqual(unitconversion.process("10 feet `quoted`"), "3.05 m ")
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.assertEqual(unitconversion.process("10 `quoted`feet"), "3.05 m")
+        self.assertEqual(unitconversion.process("4 cats"), None)
+        self.assertEqual(unitconversion.process("4 cats"), None)
+        self.assertEqual(cache.getStats()["hits"], 3)
+        self.assertEqual(cache.getStats()["misses"], 3)
+
+    def test_cache_keys_on_options(self):
+        unitconversion.enableCache()
+        decimals = unitconversion.ConversionContext(useSignificant=False, decimals=1)
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.assertEqual(unitconversion.process("10 feet", decimals), "3 m")
+
+    def test_cache_bounds(self):
+        cache = unitconversion.enableCache(maxEntries=2)
+        for raw in ["1 ft", "2 ft", "3 ft", "1 ft"]:
+            unitconversion.process(raw)
+        self.assertEqual(cache.getStats()["entries"], 2)
+        self.assertEqual(cache.getStats()["evictions"], 2)
+        self.assertEqual(cache.getStats()["hits"], 0)
+
+        cache = unitconversion.enableCache(maxBytes=5000)
+        unitconversion.process("1 ft " * 400)
+        unitconversion.process("2 ft " * 400)
+        self.assertEqual(cache.getStats()["entries"], 1)
+        self.assertLessEqual(cache.getStats()["bytes"], 5000)
+
+    def test_cache_ttl_and_clear(self):
+        cache = unitconversion.enableCache(ttl=0)
+        unitconversion.process("10 feet")
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.assertEqual(cache.getStats()["hits"], 0)
+
+        cache = unitconversion.enableCache()
+        unitconversion.process("10 feet")
+        unitconversion.clearCache()
+        self.assertEqual(cache.getStats()["entries"], 0)
+
+
+class TestUnitpediaIndex(unittest.TestCase):
+    patterns = ["(k(ilo)?|c(enti)?|m(illi)?)?m(eters?|etres?)?", "f(oo|ee)?t|'|′", "mi(les?)?",
+                "((°|º|deg(ree)?s?) ?)?(fahrenheit|freedom|f)", "((kilo)? ?gram(me)?$)|(kilo$)|(kg$)", "bad[a-z]+"]
+
+    def setUp(self):
+        self.regexes = [re.compile(pattern, re.IGNORECASE) for pattern in self.patterns]
+        self.index = unitpediaindex.ArticleIndex(self.regexes)
+
+    def test_expand_pattern(self):
+        self.assertEqual(unitpediaindex.expandPattern("mi(les?)?"), {"mi", "mile", "miles"})
+        self.assertEqual(unitpediaindex.expandPattern("(?:a|b)c?"), {"a", "ac", "b", "bc"})
+        self.assertIsNone(unitpediaindex.expandPattern("bad[a-z]+"))
+        self.assertIsNone(unitpediaindex.expandPattern("a*"))
+
+    def test_find_matches_regex_scan(self):
+        searches = ["m", "KM", "centimetres", "feet", "'", "miles", "°F", "deg freedom", "kg", "kilogramme",
+                    "kg\n", "gramkg", "badword", "nothing", "", "mm", "F", "ft"]
+        for search in searches:
+            expected = next((position for position, regex in enumerate(self.regexes) if regex.fullmatch(search)), None)
+            self.assertEqual(self.index.find(search), expected, search)
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest("fahr", 1), [3])
+        self.assertEqual(self.index.suggest("kilogrm", 1), [4])
+        self.assertEqual(self.index.suggest("zzz"), [])
+
+
+class TestUnitpedia(unittest.TestCase):
+    def test_lazy_store(self):
+        store = unitpedialib.InformationArticleStore(unitpedialib.ARTICLES_FILE, 2)
+        self.assertIsNone(store._records)
+        self.assertEqual(store.getArticle(store.find("kilogram")).longname, "kilogramme or kilogram")
+        self.assertEqual(store.getArticle(store.find("FT")).shortname, "ft")
+        self.assertIsNone(store.find("nothing"))
+        for position in range(store.getCount()):
+            store.getArticle(position)
+        self.assertEqual(store.getArticle.cache_info().currsize, 2)
+        store.reload()
+        self.assertIsNone(store._records)
+
+    def test_suggest(self):
+        self.assertEqual(unitpedialib.suggest("fahr", 1), ["Fahrenheit scale"])
+
+
+class TestProcessMany(unittest.TestCase):
+    def test_process_many(self):
+        messages = ["10 feet", "no units", "4 acres", "10feet"] * 50
+        expected = [unitconversion.process(raw) for raw in messages]
+        self.assertEqual(list(unitconversion.process_many(messages)), expected)
+        self.assertEqual(list(unitconversion.process_many(iter(messages), processes=2, chunksize=8)), expected)
+
+    def test_process_many_is_lazy(self):
+        results = unitconversion.process_many(["10 feet", None])
+        self.assertEqual(next(results), "3.05 m")
+
+    def test_read_messages(self):
+        warnings = io.StringIO()
+        lines = ['{"content": "5 ft"}\n', '\n', 'not json\n', '{"content": 5}\n', '"3 miles"\r\n']
+        self.assertEqual(list(convert.read_messages(lines, True, warnings)), [
+            ({"content": "5 ft"}, "5 ft"), ({"line": "not json"}, ""), ({"content": 5}, ""), ({"content": "3 miles"}, "3 miles")])
+        self.assertEqual(len(warnings.getvalue().splitlines()), 2)
+        self.assertEqual(list(convert.read_messages(["5 ft\r\n", "\n"], False)), [("5 ft", "5 ft"), ("", "")])
+
+
+class TestConversionPool(unittest.TestCase):
+    def run_pool(self, messages, **options):
+        async def convert_all():
+            pool = conversionpool.ConversionPool(**options)
+            results = await asyncio.gather(*[pool.process(raw) for raw in messages])
+            await asyncio.sleep(0.05)
+            pool.close()
+            return pool, results
+        return asyncio.run(convert_all())
+
+    def test_pool_converts(self):
+        pool, results = self.run_pool(["10 feet", "no units", "4 acres"], workers=2)
+        self.assertEqual(results, ["3.05 m", None, "16200 m²"])
+        self.assertEqual(pool.getStats()["processed"], 3)
+        self.assertEqual(pool.getQueueDepth(), 0)
+
+    def test_pool_drops_when_full(self):
+        pool, results = self.run_pool(["10 feet"] * 5, workers=1, maxQueue=2)
+        self.assertEqual(results.count("3.05 m"), 2)
+        self.assertEqual(pool.getStats()["dropped"], 3)
+
+    def test_pool_timeout(self):
+        pool, results = self.run_pool(["10 feet"], workers=1, timeout=0)
+        self.assertEqual(results, [None])
+        self.assertEqual(pool.getStats()["timedOut"], 1)
+        self.assertEqual(pool.getQueueDepth(), 0)
+
+class TestUnitRegistry(unittest.TestCase):
+    def setUp(self):
+        with open(unitconversion.UNITS_FILE, "r", encoding="utf-8") as unitsFile:
+            self.table = json.load(unitsFile)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_table(self, table):
+        path = os.path.join(self.directory.name, "units.json")
+        with open(path, "w", encoding="utf-8") as unitsFile:
+            json.dump(table, unitsFile)
+        return path
+
+    def test_validation(self):
+        unitconversion.validateUnitTable(self.table)
+        broken = [
+            ("type", "FURLONGS"),
+            ("factor", "big"),
+            ("factor", True),
+            ("regex", "fe(et"),
+            ("regex", "(feet)?"),
+            ("regex", "\\s?ft"),
+            ("regex", " ?(feet|ft)"),
+            ("regex", "[0-9]*ft"),
+            ("regex", "(\\d+)?inch(es)?"),
+            ("regex", ".?sq ft"),
+            ("caseSensitive", "yes"),
+            ("colour", "red"),
+        ]
+        for key, value in broken:
+            table = json.loads(json.dumps(self.table))
+            table["units"][0][key] = value
+            with self.assertRaises(unitconversion.UnitRegistryError, msg=key):
+                unitconversion.validateUnitTable(table)
+        table = json.loads(json.dumps(self.table))
+        del table["units"][0]["factor"]
+        with self.assertRaises(unitconversion.UnitRegistryError):
+            unitconversion.validateUnitTable(table)
+        with self.assertRaises(unitconversion.UnitRegistryError):
+            unitconversion.loadRegistry(self.write_table({"units": []}), None)
+        for typeName in ["SPACED", "TIMEBUDGET", "UNITS_FILE", "REMOVE_REGEX"]:
+            table = json.loads(json.dumps(self.table))
+            table["unitTypes"][typeName] = {"m": 1}
+            with self.assertRaises(unitconversion.UnitRegistryError, msg=typeName):
+                unitconversion.validateUnitTable(table)
+        self.assertEqual(unitconversion.SPACED, " ")
+
+    def test_table_cache(self):
+        path = self.write_table(self.table)
+        cachePath = os.path.join(self.directory.name, "cache", "units.marshal")
+        cold = unitconversion.loadRegistry(path, cachePath)
+        self.assertTrue(os.path.exists(cachePath))
+        # A warm start does not validate the table again.
+        originalValidate = unitconversion.validateUnitTable
+        def validate(table):
+            raise AssertionError("validated a cached table")
+        unitconversion.validateUnitTable = validate
+        self.addCleanup(setattr, unitconversion, "validateUnitTable", originalValidate)
+        warm = unitconversion.loadRegistry(path, cachePath)
+        self.assertEqual([unit.getName() for unit in warm.units], [unit.getName() for unit in unitconversion.units])
+        for text in ["10 feet", "5 Cal and 5 cal", "70 °F", "3 stone 12 lbs", "2 inch squared"]:
+            coldMessage, warmMessage = unitconversion.ModificableMessage(text), unitconversion.ModificableMessage(text)
+            cold.matcher.convert(coldMessage)
+            warm.matcher.convert(warmMessage)
+            self.assertEqual(warmMessage.getText(), coldMessage.getText())
+        # A changed table does not use the cache of the old one.
+        unitconversion.validateUnitTable = originalValidate
+        self.table["units"] = self.table["units"][:1]
+        changed = unitconversion.loadRegistry(self.write_table(self.table), cachePath)
+        self.assertEqual(len(changed.units), 1)
+
+    def test_reload_units(self):
+        self.addCleanup(unitconversion.reloadUnits)
+        self.addCleanup(unitconversion.disableCache)
+        unitconversion.enableCache()
+        self.assertEqual(unitconversion.process("10 feet"), "3.05 m")
+        self.table["units"] = [unit for unit in self.table["units"] if unit["name"] != "foot"]
+        path = self.write_table(self.table)
+        unitconversion.reloadUnits(path, None)
+        self.assertIsNone(unitconversion.process("10 feet"))
+        self.assertNotIn("foot", [unit.getName() for unit in unitconversion.units])
+        # An invalid table is not swapped in.
+        with self.assertRaises(unitconversion.UnitRegistryError):
+            unitconversion.reloadUnits(self.write_table({"units": []}), None)
+        self.assertIsNone(unitconversion.process("10 feet"))
+        self.assertEqual(unitconversion.process("4 acres"), "16200 m²")
+
+    def test_reload_while_processing(self):
+        self.addCleanup(unitconversion.reloadUnits)
+        table = dict(self.table, units=[unit for unit in self.table["units"] if unit["name"] != "mile"])
+        path = self.write_table(table)
+        message = "5 miles and 10 feet"
+        expected = {"8.05 km and 3.05 m", "5 miles and 3.05 m"}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = executor.map(lambda _: unitconversion.process(message), range(2000))
+            for _ in range(5):
+                unitconversion.reloadUnits(path, None)
+                unitconversion.reloadUnits(unitconversion.UNITS_FILE, None)
+            self.assertLessEqual(set(results), expected)
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.metrics = unitconversion.enableMetrics()
+        self.addCleanup(unitconversion.disableMetrics)
+
+    def test_histogram(self):
+        histogram = instrumentation.Histogram((0.001, 0.01, 0.1))
+        for seconds in [0.0005, 0.005, 0.005, 0.05, 5]:
+            histogram.observe(seconds)
+        self.assertEqual(histogram.getBuckets(), [(0.001, 1), (0.01, 3), (0.1, 4), (float("inf"), 5)])
+        self.assertEqual(histogram.getQuantile(0.5), 0.01)
+        self.assertEqual(histogram.getQuantile(1), float("inf"))
+        self.assertIsNone(instrumentation.Histogram().getQuantile(0.5))
+
+    def test_process_records_stages(self):
+        self.assertEqual(unitconversion.process("10 feet and 2 miles"), "3.05 m and 3.22 km")
+        self.assertIsNone(unitconversion.process("no numbers here"))
+        self.assertIsNone(unitconversion.process("10 things"))
+        self.assertEqual(self.metrics.getOutcomes(), {"converted": 1, "prefiltered": 1, "unchanged": 1})
+        self.assertEqual(self.metrics.getUnitHits(), {"foot": 1, "mile": 1})
+        stages = self.metrics.getStageStats()
+        self.assertEqual(stages["prefilter"][0], 3)
+        self.assertEqual(stages["match"][0], 2)
+        self.assertEqual(stages["format"][0], 2)
+        # A value that no unit converts is not counted as a hit.
+        self.assertEqual(unitconversion.process("0 st"), None)
+        self.assertEqual(self.metrics.getUnitHits(), {"foot": 1, "mile": 1})
+
+    def test_render_and_endpoint(self):
+        unitconversion.process("10 feet")
+        self.metrics.addGauges(lambda: {"queue_depth": 3})
+        server = instrumentation.startServer(self.metrics, 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1])) as response:
+            text = response.read().decode("utf-8")
+        self.assertIn('unitcorrector_stage_seconds_count{stage="match"} 1', text)
+        self.assertIn('unitcorrector_stage_seconds_bucket{stage="match",le="+Inf"} 1', text)
+        self.assertIn('unitcorrector_messages_total{outcome="converted"} 1', text)
+        self.assertIn('unitcorrector_unit_hits_total{unit="foot"} 1', text)
+        self.assertIn('unitcorrector_queue_depth 3.0', text)
+
+    def test_sampling_profiler(self):
+        profiler = instrumentation.SamplingProfiler()
+        self.assertEqual(profiler.run(unitconversion.process, "10 feet"), "3.05 m")
+        profiler.start(1.0)
+        self.assertTrue(profiler.isActive())
+        self.assertEqual(profiler.run(unitconversion.process, "10 feet"), "3.05 m")
+        report = profiler.stop()
+        self.assertFalse(profiler.isActive())
+        self.assertEqual(profiler.samples, 1)
+        self.assertIn("process", report)
+
+    def test_sampling_profiler_records_one_thread(self):
+        profiler = instrumentation.SamplingProfiler()
+        stop = time.monotonic() + 0.3
+
+        def otherWorker():
+            while time.monotonic() < stop:
+                unitconversion.roundsignificant(1234.5)
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(otherWorker)
+            time.sleep(0.02)
+            profiler.start(1.0)
+            profiler.run(time.sleep, 0.1)
+        report = profiler.stop(None)
+        self.assertIn("sleep", report)
+        self.assertNotIn("roundsignificant", report)
+
+class TestReplyScheduler(unittest.TestCase):
+    def run_scheduler(self, actions, **options):
+        sent = []
+
+        async def send(channel, text):
+            sent.append((channel, text, time.monotonic()))
+
+        async def run():
+            scheduler = replyscheduler.ReplyScheduler(send, **options)
+            for action in actions:
+                if isinstance(action, float):
+                    await asyncio.sleep(action)
+                elif callable(action):
+                    action(scheduler)
+                else:
+                    scheduler.schedule(*action)
+            while scheduler.getStats()["channels"]:
+                await asyncio.sleep(0.01)
+            return scheduler
+
+        return asyncio.run(run()), sent
+
+    def test_coalesces_bursts(self):
+        scheduler, sent = self.run_scheduler([("a", "one"), ("a", "two"), 0.01, ("a", "three"), ("a", "four")], rate=1, per=0.1)
+        self.assertEqual([text for channel, text, _ in sent], ["one\ntwo", "three\nfour"])
+        self.assertGreaterEqual(sent[1][2] - sent[0][2], 0.09)
+        self.assertEqual(scheduler.getStats()["coalesced"], 2)
+
+    def test_max_length(self):
+        scheduler, sent = self.run_scheduler([("a", "x" * 6), ("a", "y" * 6), ("a", "z" * 3)], rate=5, per=0.1, maxLength=10)
+        self.assertEqual([text for channel, text, _ in sent], ["x" * 6, "y" * 6 + "\n" + "z" * 3])
+
+    def test_drops_stale_replies(self):
+        scheduler, sent = self.run_scheduler([("a", "one"), 0.01, ("a", "two")], rate=1, per=0.2, maxAge=0.05)
+        self.assertEqual([text for channel, text, _ in sent], ["one"])
+        self.assertEqual(scheduler.getStats()["stale"], 1)
+
+    def test_channels_do_not_wait_on_each_other(self):
+        scheduler, sent = self.run_scheduler([("a", "one"), 0.01, ("a", "two"), ("b", "three")], rate=1, per=0.2)
+        self.assertEqual([(channel, text) for channel, text, _ in sent], [("a", "one"), ("b", "three"), ("a", "two")])
+        self.assertLess(sent[1][2] - sent[0][2], 0.1)
+
+    def test_replace_waiting_replies(self):
+        sentReplies = []
+        actions = [("a", "one", 1), ("a", "two", 2), 0.01, ("a", "three", 3), ("a", "four", 4),
+                   lambda scheduler: self.assertTrue(scheduler.replace("a", 3, "THREE")),
+                   lambda scheduler: self.assertTrue(scheduler.replace("a", 4, None)),
+                   lambda scheduler: self.assertFalse(scheduler.replace("a", 1, "ONE"))]
+        scheduler, sent = self.run_scheduler(actions, rate=1, per=0.1, onSent=lambda channel, result, keys, texts: sentReplies.append((keys, texts)))
+        self.assertEqual([text for channel, text, _ in sent], ["one\ntwo", "THREE"])
+        self.assertEqual(sentReplies, [([1, 2], ["one", "two"]), ([3], ["THREE"])])
+
+class TestIncrementalConversion(unittest.TestCase):
+    def test_edits_match_full_conversion(self):
+        rng = random.Random(21)
+        pieces = ["5 ft", " 10 miles", "3", " ", "x", "−2 lbs", "`", "\n", "per hour", "!", " 0 F", "12.5 inches", " " * 70, "\t" * 90]
+        for raw in ["10 feet and 5 miles", "I weigh 180 lbs and walk 3 miles per hour", "nothing here", "`5 ft` 6 ft " * 5]:
+            previous = unitconversion.processIncremental(raw)
+            self.assertEqual(previous.result, unitconversion.process(raw))
+            for _ in range(200):
+                # Every fourth edit is at the start, where a number is matched differently.
+                start = 0 if rng.random() < 0.25 else rng.randint(0, len(raw))
+                end = min(len(raw), start + rng.randint(0, 8))
+                raw = raw[:start] + "".join(rng.choice(pieces) for _ in range(rng.randint(0, 2))) + raw[end:]
+                previous = unitconversion.processIncremental(raw, previous)
+                self.assertEqual(previous.result, unitconversion.process(raw), raw)
+
+    def test_edits_at_the_start(self):
+        for old, new in [("5 ft", "x 5 ft"), ("5 ft", "x5 ft"), (" 5 ft", "x 5 ft"), ("ab5 ft", "5 ft"), ("ab 5 ft", " 5 ft"), ("x 5 ft", "5 ft"), ("5 ft", "5 ft")]:
+            edited = unitconversion.processIncremental(new, unitconversion.processIncremental(old))
+            self.assertEqual(edited.result, unitconversion.process(new), (old, new))
+
+    def test_edits_after_long_whitespace(self):
+        gap = " " * (unitconversion.EDITCONTEXT + 16)
+        for old, new in [("I ran 5" + gap + "xx today", "I ran 5" + gap + "ft today"), ("I ran 5" + gap + "ft today", "I ran 5" + gap + "xx today"),
+                         ("I ran 5" + gap + "today", "I ran 5" + gap + "ft today"), ("I ran 5" + gap + "ft", "I ran 5" + gap + "\t" + gap + "ft")]:
+            edited = unitconversion.processIncremental(new, unitconversion.processIncremental(old))
+            self.assertEqual(edited.result, unitconversion.process(new), (old, new))
+
+    def test_reuses_unchanged_replacements(self):
+        raw = "it is 10 feet long and " * 100
+        previous = unitconversion.processIncremental(raw)
+        edited = unitconversion.processIncremental(raw[:989] + "12 miles " + raw[989:], previous)
+        self.assertEqual(len(edited.replacements), 101)
+        # Replacements before the edit are the same objects, the ones after it are moved.
+        self.assertIs(edited.replacements[0], previous.replacements[0])
+        self.assertEqual(edited.replacements[-1][0], previous.replacements[-1][0] + 9)
+        self.assertEqual(edited.result, unitconversion.process(raw[:989] + "12 miles " + raw[989:]))
+
+    def test_other_options_convert_again(self):
+        previous = unitconversion.processIncremental("10 feet and 5 miles")
+        decimals = unitconversion.ConversionContext(useSignificant=False, decimals=1)
+        self.assertEqual(unitconversion.processIncremental("10 feet and 6 miles", previous, decimals).result, "3 m and 9.7 km")
+
+    def test_prefilter_cache_and_metrics(self):
+        metrics = unitconversion.enableMetrics(instrumentation.Metrics())
+        self.addCleanup(unitconversion.disableMetrics)
+        cache = unitconversion.enableCache()
+        self.addCleanup(unitconversion.disableCache)
+        prefiltered = unitconversion.processIncremental("hello there")
+        self.assertIsNone(prefiltered.result)
+        first = unitconversion.processIncremental("10 feet")
+        cached = unitconversion.processIncremental("10 feet")
+        self.assertEqual(cached.result, "3.05 m")
+        self.assertEqual(metrics.getOutcomes(), {"prefiltered": 1, "converted": 1, "cached": 1})
+        self.assertEqual(cache.getStats()["hits"], 1)
+        self.assertLessEqual({"prefilter", "remove_quoted", "match", "format"}, set(metrics.getStageStats()))
+        # Edits of a conversion without known replacements are converted in full, the others incrementally.
+        for previous in (prefiltered, first, cached):
+            self.assertEqual(unitconversion.processIncremental("10 feet and 3 miles", previous).result, "3.05 m and 4.83 km")
+
+    def test_tracker_bounds(self):
+        tracker = edittracker.EditTracker(maxEntries=2)
+        for messageId in (1, 2, 3):
+            tracker.track(messageId, unitconversion.processIncremental("{} ft".format(messageId)))
+        self.assertIsNone(tracker.get(1))
+        self.assertEqual(tracker.getStats(), {"messages": 2, "evictions": 1})
+        tracker.get(2)
+        tracker.track(4, None)
+        self.assertIsNotNone(tracker.get(2))
+        self.assertIsNone(tracker.get(3))
+
+    def test_tracker_replies(self):
+        tracker = edittracker.EditTracker()
+        tracker.track(1, None)
+        tracker.track(2, None)
+        reply = tracker.setReply([1, 2, 3], 100, ["one", "two", "three"])
+        tracked = tracker.get(2)
+        self.assertIs(tracked.reply, reply)
+        self.assertEqual(tracked.index, 1)
+        reply.pieces[tracked.index] = None
+        self.assertEqual(reply.getText(), "one\nthree")
+        # A message keeps its reply when it is converted again.
+        self.assertIs(tracker.track(2, None).reply, reply)
+
+class TestOutputAssembly(unittest.TestCase):
+    def test_join_replacements(self):
+        self.assertEqual(unitconversion.joinReplacements("a 10 ft b 2 mi", [(2, 7, "3.05 m"), (10, 14, "3.22 km")]), "a 3.05 m b 3.22 km")
+        self.assertEqual(unitconversion.joinReplacements("5 ft", [(0, 4, "1.52 m")]), "1.52 m")
+        self.assertIsNone(unitconversion.joinReplacements("no units", []))
+
+    def test_memory(self):
+        raw = ("it is 5 ft or 10 miles, 3 lbs and 70 F! " * 100)[:4000]
+        replacements = unitconversion.matcher.findReplacements(raw, unitconversion.ConversionContext())
+        expected = unitconversion.process(raw)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            result = unitconversion.process(raw)
+            peak = tracemalloc.get_traced_memory()[1] - start
+
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            joined = unitconversion.joinReplacements(raw, replacements)
+            joinPeak = tracemalloc.get_traced_memory()[1] - start
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(result, expected)
+        self.assertEqual(joined, expected)
+        # All replacements are kept as small tuples: a few hundred bytes per converted number.
+        self.assertLess(peak, 400 * len(replacements) + 10 * len(raw))
+        # The output is built once: the pieces of the text and the result, not a copy per replacement.
+        self.assertLess(joinPeak, 100 * len(replacements) + 2 * sys.getsizeof(expected))
+        # Nothing but the two results stays allocated, besides what CPython keeps in its free lists (floats).
+        onlyModule = [tracemalloc.Filter(True, unitconversion.__file__)]
+        leftover = sum(stat.size_diff for stat in after.filter_traces(onlyModule).compare_to(before.filter_traces(onlyModule), "filename"))
+        self.assertLess(leftover, 2 * sys.getsizeof(expected) + 4096)
+
+class TestGuildSettings(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "guildsettings.json")
+        self.guild = SimpleNamespace(id=1, roles=[])
+        self.guild.roles = [SimpleNamespace(id=10, name="@everyone", guild=self.guild), SimpleNamespace(id=11, name="imperial certified", guild=self.guild)]
+        self.channel = SimpleNamespace(id=100)
+
+    def message(self, roles, guild=True):
+        return SimpleNamespace(guild=self.guild if guild else None, channel=self.channel, author=SimpleNamespace(roles=roles))
+
+    def test_opt_out_role(self):
+        settings = guildsettings.GuildSettings()
+        self.assertTrue(settings.shouldCorrect(self.message([self.guild.roles[0]])))
+        self.assertFalse(settings.shouldCorrect(self.message(self.guild.roles)))
+        self.assertTrue(settings.shouldCorrect(self.message(self.guild.roles, guild=False)))
+
+    def test_role_events(self):
+        settings = guildsettings.GuildSettings()
+        settings.getOptOutRoles(self.guild)
+        # The roles are only scanned once, afterwards they follow the role events.
+        self.guild.roles = None
+        renamed = SimpleNamespace(id=11, name="metric enjoyer", guild=self.guild)
+        settings.updateRole(renamed)
+        self.assertTrue(settings.shouldCorrect(self.message([renamed])))
+        created = SimpleNamespace(id=12, name="imperial certified", guild=self.guild)
+        settings.updateRole(created)
+        self.assertFalse(settings.shouldCorrect(self.message([created])))
+        settings.removeRole(created)
+        self.assertTrue(settings.shouldCorrect(self.message([created])))
+
+    def test_opt_outs_are_saved(self):
+        settings = guildsettings.GuildSettings(self.path)
+        settings.setChannelEnabled(self.channel, False)
+        self.assertFalse(settings.shouldCorrect(self.message([])))
+        settings = guildsettings.GuildSettings(self.path)
+        self.assertFalse(settings.shouldCorrect(self.message([])))
+        settings.setChannelEnabled(self.channel, True)
+        settings.setGuildEnabled(self.guild, False)
+        self.assertFalse(guildsettings.GuildSettings(self.path).shouldCorrect(self.message([])))
+        self.assertFalse(settings.isGuildEnabled(self.guild))
+        self.assertTrue(settings.isChannelEnabled(self.channel))
+
+    def test_processes_keep_each_others_opt_outs(self):
+        first = guildsettings.GuildSettings(self.path)
+        second = guildsettings.GuildSettings(self.path)
+        first.setChannelEnabled(self.channel, False)
+        otherGuild = SimpleNamespace(id=2, roles=[])
+        second.setGuildEnabled(otherGuild, False)
+        second.setGuildEnabled(self.guild, True)
+        saved = guildsettings.GuildSettings(self.path)
+        self.assertFalse(saved.isChannelEnabled(self.channel))
+        self.assertFalse(saved.isGuildEnabled(otherGuild))
+        self.assertEqual(os.listdir(self.directory.name), ["guildsettings.json"])
+
+class TestLauncher(unittest.TestCase):
+    def test_shard_ranges(self):
+        self.assertEqual(launcher.shardRanges(10, 3), [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]])
+        self.assertEqual(launcher.shardRanges(2, 2), [[0], [1]])
+        self.assertEqual(launcher.aggregateStats({0: {"processed": 2, "guilds": 1}, 1: {"processed": 3, "guilds": 4}}), {"processed": 5, "guilds": 5})
+
+    def test_restarts_crashed_processes(self):
+        originalDelay = launcher.RESTART_DELAY
+        launcher.RESTART_DELAY = 0.0
+        self.addCleanup(setattr, launcher, "RESTART_DELAY", originalDelay)
+        shardLauncher = launcher.Launcher(2, 5, target=crashOnce, startMethod="fork")
+        self.addCleanup(shardLauncher.stop)
+        shardLauncher.start()
+        deadline = time.monotonic() + 10
+        while shardLauncher.restarts < 2 and time.monotonic() < deadline:
+            shardLauncher.poll()
+            time.sleep(0.05)
+        self.assertEqual(shardLauncher.restarts, 2)
+        while len([key for key in shardLauncher.stats.keys() if isinstance(key, int)]) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(launcher.aggregateStats({index: shardLauncher.stats[index] for index in (0, 1)}), {"shards": 5})
+
+class TestLoadTest(unittest.TestCase):
+    # The message path of the bot (see corrector.py), with the fake Discord objects of the load test.
+    def run_pipeline(self, run, botUser=None):
+        async def main():
+            pool = conversionpool.ConversionPool(workers=2)
+            tracker = edittracker.EditTracker()
+            scheduler = replyscheduler.ReplyScheduler(lambda channel, text: channel.send(text), onSent=tracker.replySent)
+            messageCorrector = corrector.Corrector(pool, guildsettings.GuildSettings(), scheduler, tracker)
+            botUserId = botUser.id if botUser is not None else None
+            try:
+                return await run(lambda message: messageCorrector.onMessage(message, botUserId), messageCorrector)
+            finally:
+                while scheduler.getQueueDepth():
+                    await asyncio.sleep(0.01)
+                pool.close()
+
+        return asyncio.run(main())
+
+    def test_replay(self):
+        server = loadtest.SyntheticServer(guilds=1, channelsPerGuild=1, roleCount=300, sendLatency=0.001)
+        guild, channel = server.guilds[0], server.channels[0]
+        certified = loadtest.FakeUser("@everyone", roles=[guild.optOutRole])
+        uncertified = loadtest.FakeUser("@here", roles=[guild.roles[0]])
+        messages = [loadtest.FakeMessage("10 feet", certified, channel), loadtest.FakeMessage("10 feet", uncertified, channel),
+                    loadtest.FakeMessage("no units", uncertified, channel)]
+        result = self.run_pipeline(lambda on_message, messageCorrector: loadtest.replay(on_message, messages, rate=100))
+        self.assertEqual(result.dispatched, 3)
+        self.assertEqual(len(result.latencies), 3)
+        self.assertGreaterEqual(result.elapsed, 0.02)
+        self.assertEqual([text for _, text in server.getSent()], ["I think @\u200bhere meant to say: ```3.05 m```"])
+
+    def test_direct_messages_and_edits(self):
+        server = loadtest.SyntheticServer(guilds=1, channelsPerGuild=1)
+        channel = server.channels[0]
+        author = server.members[server.guilds[0].id][0]
+        if server.guilds[0].optOutRole in author.roles:
+            author = loadtest.FakeUser("@here", roles=[server.guilds[0].roles[0]])
+        botUser = loadtest.FakeUser("UnitCorrector", bot=True)
+        first = loadtest.FakeMessage("10 feet", author, channel)
+        second = loadtest.FakeMessage("no units yet", author, channel)
+        direct = loadtest.FakeMessage("5 miles", server.directUser, server.directChannel)
+
+        async def run(on_message, messageCorrector):
+            for message in (first, second, direct, loadtest.FakeMessage("3 feet", botUser, channel)):
+                await on_message(message)
+            while not server.getSent():
+                await asyncio.sleep(0.01)
+            # Waits for the reply with the corrections of first, then edits both messages.
+            await asyncio.sleep(0.05)
+            editedFirst = loadtest.FakeMessage("20 feet", author, channel)
+            editedFirst.id = first.id
+            await messageCorrector.onMessageEdit(first, editedFirst)
+            editedSecond = loadtest.FakeMessage("now 2 miles", author, channel)
+            editedSecond.id = second.id
+            await messageCorrector.onMessageEdit(second, editedSecond)
+            editedFirst.content = "no units anymore"
+            await messageCorrector.onMessageEdit(first, editedFirst)
+
+        self.run_pipeline(run, botUser)
+        self.assertEqual([text for _, text in server.directChannel.sent], ["I think you meant to say: ```8.05 km```"])
+        name = author.display_name
+        sentTexts = [text for _, text in channel.sent]
+        self.assertEqual(sentTexts[0], "I think {} meant to say: ```3.05 m```".format(name))
+        self.assertEqual(channel.edited[0][1], "I think {} meant to say: ```6.1 m```".format(name))
+        # The second message had no correction yet, so it gets a new reply, and the first one's reply is deleted.
+        self.assertEqual(sentTexts[1:], ["I think {} meant to say: ```now 3.22 km```".format(name)])
+        self.assertEqual(channel.deleted, [channel.edited[0][0]])
+
+    def test_find_max_rate(self):
+        server = loadtest.SyntheticServer(seed=1)
+        messages = server.syntheticMessages(60, seed=1)
+        self.assertEqual(len(messages), 60)
+        best, results = self.run_pipeline(lambda on_message, messageCorrector: loadtest.findMaxRate(on_message, lambda rate: messages[:rate // 10], [100, 200, 400], maxLatency=1.0, maxLag=1.0))
+        self.assertEqual([rate for rate, _ in results][:1], [100])
+        self.assertIsNotNone(best)
+        self.assertGreater(len(server.getSent()), 0)
+
 if not message:
     print("Running unit tests")
     unittest.main()
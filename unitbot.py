@@ -13,21 +13,128 @@
 
 # Licenced under: MIT License, Copyright (c) 2018 Wendelstein7 and ficolas2
 
+import asyncio
 import datetime
 import os
 import sys
+import time
 from datetime import datetime, date
 
 import discord
 from discord.ext import commands
 
-import filter
-
+import conversionpool
+import corrector
+import edittracker
+import guildsettings
+import instrumentation
+import launcher
+import replyscheduler
 import unitconversion
 import unitpedialib
 
+CONVERSION_WORKERS = 4    # Option: Number of workers that convert messages. DEFAULT: 4
+CONVERSION_PROCESSES = False    # Option: Should the workers be processes instead of threads? DEFAULT: False
+CONVERSION_QUEUE = 64    # Option: Maximum number of messages waiting for conversion, further messages are dropped. DEFAULT: 64
+CONVERSION_TIMEOUT = 2.0    # Option: Seconds after which the conversion of a message is skipped. DEFAULT: 2.0
+CONVERSION_CPU_BUDGET = 0.25    # Option: CPU seconds a worker may spend on one message before it gives up on it. DEFAULT: 0.25
+RESULT_CACHE_ENTRIES = 0    # Option: Number of conversion results to cache for repeated messages, 0 disables the cache. DEFAULT: 0
+RESULT_CACHE_BYTES = 4 * 1024 * 1024    # Option: Approximate memory budget of the result cache in bytes. DEFAULT: 4 MiB
+RESULT_CACHE_TTL = 3600    # Option: Seconds after which a cached result expires, None keeps results until evicted. DEFAULT: 3600
+TOKEN_FILE = 'token'    # Option: File with the private token of the bot. DEFAULT: 'token'
+STATS_INTERVAL = 30    # Option: Seconds between updates of the statistics shared with the other processes, when started by launcher.py. DEFAULT: 30
+GUILD_SETTINGS_FILE = 'guildsettings.json'    # Option: File in which the guilds and channels that opted out are saved. DEFAULT: 'guildsettings.json'
+REPLY_RATE = 5    # Option: Number of replies the bot sends per channel within REPLY_PER seconds, the rate limit of Discord. DEFAULT: 5
+REPLY_PER = 5.0    # Option: Seconds of the per channel rate limit. DEFAULT: 5.0
+REPLY_MAX_AGE = 10.0    # Option: Seconds after which a correction that could not be sent yet is dropped. DEFAULT: 10.0
+REPLY_QUEUE = 20    # Option: Maximum number of corrections waiting per channel, the oldest are dropped. DEFAULT: 20
+METRICS_ENABLED = True    # Option: Should the time spent per stage of the message path be recorded, for !stats and the metrics endpoint? DEFAULT: True
+METRICS_PORT = 0    # Option: Local port of the HTTP metrics endpoint (Prometheus text format at /metrics), 0 disables it. Conversions are only measured with thread workers. DEFAULT: 0
+METRICS_HOST = "127.0.0.1"    # Option: Address the metrics endpoint listens on. DEFAULT: "127.0.0.1" (local only)
+PROFILE_SAMPLE_RATE = 0.1    # Option: Fraction of conversions that run under the profiler after !profile start. DEFAULT: 0.1
+EDITED_MESSAGES = 1024    # Option: Number of recent messages whose edits are corrected again, by editing the earlier correction. 0 disables correcting edits. DEFAULT: 1024
+UNITS_WATCH_INTERVAL = 0    # Option: Seconds between checks of the unit table file for changes, which are then reloaded. 0 only reloads on !reloadunits. DEFAULT: 0
+
 description = """UnitCorrector: A community-beveloped open source Discord bot that corrects non-SI units to SI ones! Also features a !unitpedia command, allowing users to learn about (all) units."""
-bot = commands.Bot(command_prefix='!', description=description)
+# Sharded, so a single process can serve large deployments. launcher.py spreads the shards over several processes.
+bot = commands.AutoShardedBot(command_prefix='!', description=description)
+profiler = instrumentation.SamplingProfiler()
+guildSettings = guildsettings.GuildSettings(GUILD_SETTINGS_FILE)
+conversionPool = conversionpool.ConversionPool(CONVERSION_WORKERS, CONVERSION_QUEUE, CONVERSION_TIMEOUT, CONVERSION_PROCESSES, profiler)
+conversionContext = unitconversion.ConversionContext(timeBudget=CONVERSION_CPU_BUDGET)
+if RESULT_CACHE_ENTRIES > 0:
+    unitconversion.enableCache(RESULT_CACHE_ENTRIES, RESULT_CACHE_BYTES, RESULT_CACHE_TTL)
+metrics = unitconversion.enableMetrics() if METRICS_ENABLED else None
+editTracker = edittracker.EditTracker(EDITED_MESSAGES) if EDITED_MESSAGES > 0 else None
+
+
+async def sendReply(channel, text):
+    lapTime = time.perf_counter()
+    sent = await channel.send(text)
+    if metrics is not None:
+        metrics.lap("send", lapTime)
+    return sent
+
+
+# The tracker remembers which reply holds the corrections of which messages, to edit it when they are edited.
+replyScheduler = replyscheduler.ReplyScheduler(sendReply, REPLY_RATE, REPLY_PER, REPLY_MAX_AGE, REPLY_QUEUE,
+                                               onSent=editTracker.replySent if editTracker is not None else None)
+messageCorrector = corrector.Corrector(conversionPool, guildSettings, replyScheduler, editTracker, conversionContext, metrics)
+
+
+# Gauges for the metrics endpoint, from the statistics that are also shown by !stats.
+def pipelineGauges():
+    poolStats = conversionPool.getStats()
+    gauges = {
+        "queue_depth": poolStats["queued"],
+        "pool_processed": poolStats["processed"],
+        "pool_dropped": poolStats["dropped"],
+        "pool_timed_out": poolStats["timedOut"],
+        "prefilter_checked": unitconversion.prefilterStats["checked"],
+        "prefilter_rejected": unitconversion.prefilterStats["rejected"],
+        "over_cpu_budget": unitconversion.budgetStats["exceeded"],
+        "reply_queue_depth": replyScheduler.getQueueDepth(),
+        "replies_sent": replyScheduler.sent,
+        "replies_stale": replyScheduler.stale,
+    }
+    if unitconversion.resultCache is not None:
+        cacheStats = unitconversion.resultCache.getStats()
+        gauges.update({"cache_entries": cacheStats["entries"], "cache_bytes": cacheStats["bytes"], "cache_hits": cacheStats["hits"], "cache_misses": cacheStats["misses"]})
+    return gauges
+
+
+if metrics is not None:
+    metrics.addGauges(pipelineGauges)
+
+# When started by launcher.py, the statistics of all processes by process index, see publishStats.
+sharedStats = None
+processIndex = 0
+
+
+# The statistics of this process that are summed over all processes.
+def getProcessStats():
+    poolStats = conversionPool.getStats()
+    return {
+        "guilds": len(bot.guilds),
+        "processed": poolStats["processed"],
+        "dropped": poolStats["dropped"],
+        "timedOut": poolStats["timedOut"],
+        "prefilterChecked": unitconversion.prefilterStats["checked"],
+        "prefilterRejected": unitconversion.prefilterStats["rejected"],
+        "overBudget": unitconversion.budgetStats["exceeded"],
+        "repliesScheduled": replyScheduler.scheduled,
+        "repliesSent": replyScheduler.sent,
+    }
+
+
+async def publishStats():
+    while True:
+        sharedStats[processIndex] = getProcessStats()
+        await asyncio.sleep(STATS_INTERVAL)
+
+
+unitsWatcher = None
+statsPublisher = None
 
 starttime = datetime.utcnow()
 longprefix = ':symbols: UnitCorrector | '
@@ -36,24 +143,83 @@ shortprefix = ':symbols: '
 credits = '**HydroNitrogen** (GH: `Wendelstein7`, <@378840449152188419>) - _Creator and main current developer_ \n**Shaq** (GH: `Shaquu`, <@197109511239106561>) - _Main current developer_ \n**ficolas** (GH: `ficolas2`, <@192368029366091777>) - _Past developer_ \n ...And other wonderful contributors, see GitHub.'
 
 
+# Reloads the unit table in the background, so the event loop keeps handling messages meanwhile.
+# Raises OSError or unitconversion.UnitRegistryError when the table cannot be loaded, the current units then stay in use.
+async def reloadUnitTable():
+    registry = await asyncio.get_running_loop().run_in_executor(None, unitconversion.reloadUnits)
+    conversionPool.reloadUnits()
+    print('[{}] Reloaded the unit table: {} units'.format(datetime.now(), len(registry.units)))
+    return registry
+
+
+# Reloads the unit table whenever its file changes.
+async def watchUnitTable():
+    lastModified = os.stat(unitconversion.UNITS_FILE).st_mtime
+    while True:
+        await asyncio.sleep(UNITS_WATCH_INTERVAL)
+        try:
+            modified = os.stat(unitconversion.UNITS_FILE).st_mtime
+        except OSError:
+            continue
+        if modified != lastModified:
+            lastModified = modified
+            try:
+                await reloadUnitTable()
+            except (OSError, unitconversion.UnitRegistryError) as error:
+                print('[{}] The unit table was not reloaded: {}'.format(datetime.now(), error))
+
+
 @bot.event
 async def on_ready():
+    global unitsWatcher, statsPublisher
     print('Discord Unit Corrector Bot: Logged in as {} (id: {})\n'.format(
         bot.user.name, bot.user.id))
+    # on_ready also fires after reconnecting, the watcher is only started once.
+    if UNITS_WATCH_INTERVAL > 0 and unitsWatcher is None:
+        unitsWatcher = asyncio.ensure_future(watchUnitTable())
+    if sharedStats is not None and statsPublisher is None:
+        statsPublisher = asyncio.ensure_future(publishStats())
 
 
 @bot.event
-# Catches send messages and corrects non-SI units if neccesary. Most of the code behind this is in 'unitconversion.py'.
+# Catches send messages and corrects non-SI units if neccesary. The message path is in 'corrector.py', most of the code behind it in 'unitconversion.py'.
 async def on_message(message):
-    if bot.user.id is not message.author.id and message.author.bot is False and (message.guild is None or (message.guild is not None and discord.utils.get(message.guild.roles, name='imperial certified') not in message.author.roles)):
-        processedMessage = unitconversion.process(message.content)
-        if processedMessage is not None:
-            correctionText = ("I think " + filter.apply_strict(message.author.display_name if message.guild is not None else "you") +
-                              " meant to say: ```" + filter.apply_strict(processedMessage) + "```")
-            await message.channel.send(correctionText)
+    await messageCorrector.onMessage(message, bot.user.id)
     await bot.process_commands(message)
 
 
+@bot.event
+# Corrects a recently sent message again when it is edited, by editing the earlier correction. See edittracker.py.
+async def on_message_edit(before, after):
+    await messageCorrector.onMessageEdit(before, after)
+
+
+@bot.event
+async def on_message_delete(message):
+    messageCorrector.onMessageDelete(message)
+
+
+# Keep the cached opt-out roles current. See guildsettings.py.
+@bot.event
+async def on_guild_role_create(role):
+    guildSettings.updateRole(role)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    guildSettings.updateRole(after)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    guildSettings.removeRole(role)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    guildSettings.forgetGuild(guild)
+
+
 @bot.event
 async def on_command(ctx):
     print('[{}] Fired {} by {}'.format(
@@ -73,6 +239,35 @@ async def unitcorrector(ctx):
     await ctx.send(shortprefix + "UnitCorrector automatically detects and corrects users who send non-SI units in their messages.\nThe bot currently supports the following units:\n```" + supportedUnits + "```")
 
 
+@bot.command(name='optout')
+@commands.guild_only()
+async def optout(ctx, scope: str = 'channel'):
+    """Stops correcting messages in this channel, or with !optout server in the whole server. Needs the manage channels or manage server permission."""
+    await setCorrecting(ctx, scope, False)
+
+
+@bot.command(name='optin')
+@commands.guild_only()
+async def optin(ctx, scope: str = 'channel'):
+    """Corrects messages in this channel, or with !optin server in the whole server, again."""
+    await setCorrecting(ctx, scope, True)
+
+
+async def setCorrecting(ctx, scope, enabled):
+    permissions = ctx.channel.permissions_for(ctx.author)
+    if scope == 'server' and permissions.manage_guild:
+        guildSettings.setGuildEnabled(ctx.guild, enabled)
+    elif scope == 'channel' and permissions.manage_channels:
+        guildSettings.setChannelEnabled(ctx.channel, enabled)
+    elif scope in ('server', 'channel'):
+        await ctx.send(shortprefix + 'You need the manage {} permission for that.'.format('server' if scope == 'server' else 'channels'))
+        return
+    else:
+        await ctx.send(shortprefix + 'Use `channel` or `server`, for example `!optout channel`.')
+        return
+    await ctx.send(shortprefix + 'UnitCorrector will {}correct messages in this {}.'.format('' if enabled else 'no longer ', scope))
+
+
 @bot.command(name='uptime', hidden=True)
 # May be deprecated, changed or removed as !about already shows the uptime.
 async def uptime(ctx):
@@ -80,6 +275,68 @@ async def uptime(ctx):
     await ctx.send(shortprefix + 'Uptime\n```Bot started: {}\nBot uptime: {}```'.format(starttime, (datetime.now() - starttime)))
 
 
+@bot.command(name='stats', hidden=True)
+@commands.is_owner()
+async def stats(ctx):
+    """Shows statistics of the conversion pipeline, for sizing the worker pool."""
+    poolStats = conversionPool.getStats()
+    await ctx.send(shortprefix + 'Conversion statistics\n```Workers: {} ({})\nQueue depth: {}/{}\nProcessed: {}\nDropped: {}\nTimed out: {}\nOver CPU budget: {}\nAverage latency: {:.2f} ms\nMax latency: {:.2f} ms\nPre-filter rejected: {}/{}```'.format(
+        poolStats["workers"], "processes" if poolStats["processes"] else "threads", poolStats["queued"], poolStats["maxQueue"],
+        poolStats["processed"], poolStats["dropped"], poolStats["timedOut"], unitconversion.budgetStats["exceeded"], poolStats["averageLatency"] * 1000, poolStats["maxLatency"] * 1000,
+        unitconversion.prefilterStats["rejected"], unitconversion.prefilterStats["checked"]))
+    if sharedStats is not None:
+        sharedStats[processIndex] = getProcessStats()
+        totals = launcher.aggregateStats(sharedStats)
+        await ctx.send(shortprefix + 'All {} processes\n```Guilds: {}\nProcessed: {}\nDropped: {}\nTimed out: {}\nOver CPU budget: {}\nPre-filter rejected: {}/{}\nReplies sent: {} messages for {} corrections```'.format(
+            len(sharedStats), totals["guilds"], totals["processed"], totals["dropped"], totals["timedOut"], totals["overBudget"],
+            totals["prefilterRejected"], totals["prefilterChecked"], totals["repliesSent"], totals["repliesScheduled"]))
+    replyStats = replyScheduler.getStats()
+    await ctx.send(shortprefix + 'Replies\n```Channels waiting: {}\nQueued: {}\nSent: {} messages for {} corrections\nMerged: {}\nStale: {}\nDropped: {}\nFailed: {}```'.format(
+        replyStats["channels"], replyStats["queued"], replyStats["sent"], replyStats["scheduled"], replyStats["coalesced"], replyStats["stale"], replyStats["dropped"], replyStats["failed"]))
+    if editTracker is not None:
+        editStats = editTracker.getStats()
+        await ctx.send(shortprefix + 'Edited messages\n```Tracked: {}/{}\nForgotten: {}```'.format(editStats["messages"], EDITED_MESSAGES, editStats["evictions"]))
+    if unitconversion.resultCache is not None:
+        cacheStats = unitconversion.resultCache.getStats()
+        await ctx.send(shortprefix + 'Result cache\n```Entries: {}\nSize: {} bytes\nHits: {}\nMisses: {}\nEvictions: {}```'.format(
+            cacheStats["entries"], cacheStats["bytes"], cacheStats["hits"], cacheStats["misses"], cacheStats["evictions"]))
+    if metrics is not None:
+        stages = '\n'.join('{:14s} {:8d} x, average {:8.3f} ms, p50 <= {:8.3f} ms, p99 <= {:8.3f} ms'.format(
+            stage, count, total / count * 1000, p50 * 1000, p99 * 1000) for stage, (count, total, p50, p99) in sorted(metrics.getStageStats().items()) if count)
+        outcomes = ', '.join('{}: {}'.format(outcome, count) for outcome, count in sorted(metrics.getOutcomes().items()))
+        unitHits = sorted(metrics.getUnitHits().items(), key=lambda hit: -hit[1])[:10]
+        topUnits = ', '.join('{}: {}'.format(unitName, count) for unitName, count in unitHits)
+        await ctx.send(shortprefix + 'Message path\n```{}\n\nOutcomes: {}\nTop units: {}```'.format(stages or 'No messages yet', outcomes or '-', topUnits or '-'))
+
+
+@bot.command(name='profile', hidden=True)
+@commands.is_owner()
+async def profile(ctx, action: str, sampleRate: float = PROFILE_SAMPLE_RATE):
+    """Profiles a sample of the conversions. Use !profile start [rate] and !profile stop."""
+    if action == 'start':
+        profiler.start(sampleRate)
+        await ctx.send(shortprefix + 'Profiling {:.0%} of the conversions, use `!profile stop` to see the results.'.format(sampleRate))
+    elif action == 'stop':
+        samples = profiler.samples
+        report = profiler.stop()
+        # Discord messages are limited to 2000 characters.
+        await ctx.send(shortprefix + 'Profile of {} conversions\n```{}```'.format(samples, report[:1800] or 'No conversions were sampled'))
+    else:
+        await ctx.send(shortprefix + 'Use `!profile start [rate]` or `!profile stop`.')
+
+
+@bot.command(name='reloadunits', hidden=True)
+@commands.is_owner()
+async def reloadunits(ctx):
+    """Reloads the unit table without restarting the bot."""
+    try:
+        registry = await reloadUnitTable()
+    except (OSError, unitconversion.UnitRegistryError) as error:
+        await ctx.send(shortprefix + 'The unit table was not reloaded, the current units stay in use.\n```{}```'.format(error))
+        return
+    await ctx.send(shortprefix + 'Reloaded the unit table: {} units.'.format(len(registry.units)))
+
+
 @bot.command(name='contributors', aliases=['credits', 'developers'])
 # Will be made a nice embed in the future if there are lots of contributors.
 async def contributors(ctx):
@@ -98,7 +355,9 @@ async def unitpedia(ctx, *, search: str):
     if result != "notfound":
         await ctx.send(embed=result)
     else:
-        await ctx.send(shortprefix + 'Sorry, your search query has not returned any results. Try to search using different words or abbreviations.\n\n*Unitpedia is not complete and needs community submissions. If you want to help expand unitpedia, please visit <https://github.com/Wendelstein7/DiscordUnitCorrector>.*')
+        suggestions = unitpedialib.suggest(search)
+        didYouMean = ' Did you mean: {}?'.format(', '.join('`' + name + '`' for name in suggestions)) if suggestions else ''
+        await ctx.send(shortprefix + 'Sorry, your search query has not returned any results. Try to search using different words or abbreviations.' + didYouMean + '\n\n*Unitpedia is not complete and needs community submissions. If you want to help expand unitpedia, please visit <https://github.com/Wendelstein7/DiscordUnitCorrector>.*')
 
 
 @unitpedia.error
@@ -129,7 +388,25 @@ async def about(ctx):
 
 
 # INFO: To run the bot yourself you must enter your bots private token in a (new) file called 'token'
-with open('token', 'r') as content_file:
-    content = content_file.read()
+def readToken(path=TOKEN_FILE):
+    with open(path, 'r') as content_file:
+        return content_file.read()
+
+
+# Runs the bot, on all shards or, when started by launcher.py, on the given shards. Nothing is
+# started at import, so tests and the launcher can import this module.
+def main(token=None, shardIds=None, shardCount=None, stats=None, index=0):
+    global sharedStats, processIndex
+    sharedStats = stats
+    processIndex = index
+    if shardCount is not None:
+        bot.shard_count = shardCount
+        bot.shard_ids = shardIds
+    if metrics is not None and METRICS_PORT:
+        # Every process of the launcher gets its own port.
+        instrumentation.startServer(metrics, METRICS_PORT + processIndex, METRICS_HOST)
+    bot.run(token if token is not None else readToken())
+
 
-bot.run(content)
+if __name__ == '__main__':
+    main()
@@ -4,138 +4,330 @@
 
 # Licenced under: MIT License, Copyright (c) 2018 Wendelstein7 and ficolas2
 
+import marshal
+import os
 import re
+import sys
+import threading
+import time
 from abc import abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
+from itertools import count, islice
 from math import log10, floor
 
-END_NUMBER_REGEX = re.compile("(^|\s)(-|−)?[0-9]+([\,\.][0-9]+)?\s*$")
+
+# Matches (without consuming) a number together with the whitespace around it, so all numbers are found in one pass.
+NUMBER_REGEX = re.compile(r"(?=((^|\s)(-|−)?[0-9]+([\,\.][0-9]+)?\s*))")
+# Quoted text (code) that is removed from messages before converting. See removeQuoted, which does the same in linear time.
 REMOVE_REGEX = re.compile("((´|`)+[^>]+(´|`)+)")
+TICK_REGEX = re.compile("[´`]+")
+# A conversion needs a digit followed (after optional whitespace) by the first character of a unit.
+# No unit starts with whitespace or a digit, so messages without such a pair can be rejected early.
+PREFILTER_REGEX = re.compile("[0-9]\\s*[^\\s0-9]")
 
 UNICODEMINUS = True    # Option: Should UNICODE minus symbol '−' be converted to a standard dash '-'?
 SPACED = " "    # Option: What should separate the number and the unit? DEFAULT: one space (" ")
 USESIGNIFICANT = True    # Option: Should rounding be done using significancy? If false, rounding will be done using decimal places. DEFAULT: True
 SIGNIFICANTFIGURES = 3    # Option: The amount of significant digits that will be kept when rounding.  Ignored when USESIGNIFICANT = False. DEFAULT: 3
 DECIMALS = 2    # Option: The amount of decimals to output after conversion. Ignored when USESIGNIFICANT = True. DEFAULT: 2
+TIMEBUDGET = None    # Option: CPU seconds a single message may take, after which its conversion is skipped. None means no limit. DEFAULT: None
+EDITCONTEXT = 64    # Option: Characters before the changed part of an edited message that are matched again by processIncremental, besides the number in front of the whitespace before them. Should be longer than a number with its unit. DEFAULT: 64
+UNITS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "units.json")    # Option: The unit table. DEFAULT: units.json next to this file
+UNITS_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "units.marshal")    # Option: Where the validated unit table is cached. None disables the cache. DEFAULT: __pycache__/units.marshal
+
+# Raised when converting a message takes longer than the time budget of its context.
+class TimeBudgetExceeded(Exception):
+    pass
+
+# The options of a single conversion. Every call of process gets its own context instead of
+# reading (and temporarily overwriting) the module level options, so process is safe to run
+# from several threads at once. Options that are not given default to the module level ones.
+class ConversionContext:
+    __slots__ = ("spacing", "useSignificant", "significantFigures", "decimals", "unicodeMinus", "timeBudget")
+
+    def __init__(self, spacing=None, useSignificant=None, significantFigures=None, decimals=None, unicodeMinus=None, timeBudget=None):
+        self.spacing = SPACED if spacing is None else spacing
+        self.useSignificant = USESIGNIFICANT if useSignificant is None else useSignificant
+        self.significantFigures = SIGNIFICANTFIGURES if significantFigures is None else significantFigures
+        self.decimals = DECIMALS if decimals is None else decimals
+        self.unicodeMinus = UNICODEMINUS if unicodeMinus is None else unicodeMinus
+        self.timeBudget = TIMEBUDGET if timeBudget is None else timeBudget
+
+    # The CPU time (of the current thread) after which a conversion started now is aborted, or None.
+    def getDeadline(self):
+        if self.timeBudget is None:
+            return
+        return time.thread_time() + self.timeBudget
+
+    # The options as a tuple, to use as part of a cache key.
+    def getKey(self):
+        return (self.spacing, self.useSignificant, self.significantFigures, self.decimals, self.unicodeMinus)
+
+    # Returns a copy of this context with a different spacing between number and unit.
+    def withSpacing(self, spacing):
+        return ConversionContext(spacing, self.useSignificant, self.significantFigures, self.decimals, self.unicodeMinus, self.timeBudget)
 
-def roundsignificant(number):
+def roundsignificant(number, significantFigures=None):
+    if significantFigures is None:
+        significantFigures = SIGNIFICANTFIGURES
     if number == 0:
         return 0
-    return round(number, -int(floor(log10(abs(number))))+SIGNIFICANTFIGURES-1)
+    return round(number, significantFigures - 1 - floor(log10(abs(number))))
 
+# A unit type is a base SI unit with its prefixed multiples, for example m, km, cm, ...
+# The multiples are frozen into sorted tables when they are added (at import time), so
+# a conversion only needs a bisect to pick the multiple instead of sorting them every time.
 class UnitType:
+    __slots__ = ("_multiples", "_sortedMultiples", "_sortedNames", "_thresholds")
 
     def __init__( self ):
         self._multiples = {}
+        self._sortedMultiples = ()
+        self._sortedNames = ()
+        self._thresholds = ()
 
     def addMultiple( self, unit, multiple ):
         self._multiples[ multiple ] = unit
+        self._sortedMultiples = tuple( sorted( self._multiples ) )
+        self._sortedNames = tuple( self._multiples[ m ] for m in self._sortedMultiples )
+        # A multiple is used for values larger than half of it.
+        self._thresholds = tuple( m/2 for m in self._sortedMultiples )
         return self
 
-    def getStringFromMultiple(self, value, multiple):
-        numberString = str((roundsignificant(value / multiple) if USESIGNIFICANT else round(value / multiple, DECIMALS)))
-        if numberString[-2:] == ".0":
+    def _formatNumber( self, value, context ):
+        numberString = str( roundsignificant( value, context.significantFigures ) if context.useSignificant else round( value, context.decimals ) )
+        if numberString.endswith( ".0" ):
             numberString = numberString[:-2]
-        return numberString + SPACED + self._multiples[multiple]
-
-    def getString( self, value ):
-        sortedMultiples = sorted(self._multiples, reverse=True)
-        for multiple in sortedMultiples:
-            if abs(value) > multiple/2:
-                return self.getStringFromMultiple(value, multiple)
-        return self.getStringFromMultiple( value, sortedMultiples[-1] )
-
-DISTANCE = UnitType().addMultiple("m", 1).addMultiple( "km", 10**3 ).addMultiple( "cm", 10**-2).addMultiple( "mm", 10**-3).addMultiple( "µm", 10**-6).addMultiple( "nm", 10**-9).addMultiple( "pm", 10**-12 )
-AREA = UnitType().addMultiple( "m²", 1 ).addMultiple( "km²", 10**6 ).addMultiple( "cm²", 10**-4).addMultiple( "mm²", 10**-6)
-VOLUME = UnitType().addMultiple( "L", 1 ).addMultiple( "mL", 10**-3 ).addMultiple( "µL", 10**-6 ).addMultiple( "nL", 10**-9 ).addMultiple( "pL", 10**-12 )
-ENERGY = UnitType().addMultiple( "J", 1 ).addMultiple( "TJ", 10**12 ).addMultiple( "GJ", 10**9 ).addMultiple( "MJ", 10**6 ).addMultiple( "kJ", 10**3 ).addMultiple( "mJ", 10**-3 ).addMultiple( "µJ", 10**-6 ).addMultiple( "nJ", 10**-9 )
-FORCE = UnitType().addMultiple( "N", 1 ).addMultiple( "MN", 10**6 ).addMultiple( "kN", 10**3 ).addMultiple( "mN", 10**-3 ).addMultiple( "µN", 10**-6 ).addMultiple( "nN", 10**-9 ).addMultiple( "pN", 10**-12 )
-TORQUE = UnitType().addMultiple( "N*m", 1 )
-VELOCITY = UnitType().addMultiple("m/s", 1).addMultiple( "km/s", 10**3 )
-MASS = UnitType().addMultiple( "g", 1 ).addMultiple( "kg", 10**3 ).addMultiple( "mg", 10**-3 ).addMultiple( "µg", 10**-6 ).addMultiple( "ng", 10**-9 ).addMultiple( "pg", 10**-12 )
-TEMPERATURE = UnitType().addMultiple( "°C", 1 )
-PRESSURE = UnitType().addMultiple( "atm", 1 )
-LUMINOUSINTENSITY = UnitType().addMultiple( "cd", 1 )
-POWER = UnitType().addMultiple( "W", 1 ).addMultiple( "pW", 10**-12 ).addMultiple( "nW", 10**-9 ).addMultiple( "µW", 10**-6 ).addMultiple( "mW", 10**-3 ).addMultiple( "kW", 10**3 ).addMultiple( "MW", 10**6 ).addMultiple( "GW", 10**9 ).addMultiple( "TW", 10**12 )
+        return numberString
+
+    def _format( self, value, multiple, name, context ):
+        return self._formatNumber( value / multiple, context ) + context.spacing + name
+
+    def getStringFromMultiple(self, value, multiple, context=None):
+        if context is None:
+            context = ConversionContext()
+        return self._format( value, multiple, self._multiples[multiple], context )
+
+    def getString( self, value, context=None ):
+        if context is None:
+            context = ConversionContext()
+        return self.getSpacedString( value, context.spacing, context )
+
+    # Like getString, with a spacing between number and unit other than the one of the context.
+    def getSpacedString( self, value, spacing, context ):
+        # The largest multiple of which the value is more than half, or the smallest multiple.
+        index = bisect_left( self._thresholds, abs(value) ) - 1
+        if index < 0:
+            index = 0
+        return self._formatNumber( value / self._sortedMultiples[index], context ) + spacing + self._sortedNames[index]
 
 class Unit:
+    __slots__ = ("_friendlyName", "_unitType", "_toSIMultiplication", "_toSIAddition")
+
     def __init__( self, friendlyName, unitType, toSIMultiplication, toSIAddition ):
         self._friendlyName = friendlyName
         self._unitType = unitType
         self._toSIMultiplication = toSIMultiplication
         self._toSIAddition = toSIAddition
 
-    def toMetric( self, value ):
+    # The value in the base SI unit, or None when the unit declines it (zero without an offset).
+    def toSI( self, value ):
         SIValue = ( value + self._toSIAddition ) * self._toSIMultiplication
         if self._toSIAddition == 0 and SIValue == 0:
             return
-        return self._unitType.getString( SIValue )
+        return SIValue
+
+    def toMetric( self, value, context=None ):
+        SIValue = self.toSI( value )
+        if SIValue is None:
+            return
+        return self._unitType.getString( SIValue, context )
 
     def getName( self ):
         return self._friendlyName
 
+    def getUnitType( self ):
+        return self._unitType
+
+    def matchAt( self, text, position ):
+        return self.getRegex().match( text, position )
+
     @abstractmethod
-    def convert( self, message ): pass
+    def getPattern( self ): pass
 
-def convertUnitInModificableMessage( message, unit_regex, toMetric ):
-    global SPACED
+    @abstractmethod
+    def getRegex( self ): pass
+
+    @abstractmethod
+    def convert( self, message, context=None ): pass
+
+def checkDeadline( deadline ):
+    if deadline is not None and time.thread_time() > deadline:
+        raise TimeBudgetExceeded()
+
+# Removes quoted text from a message, with the same result as REMOVE_REGEX.sub("", text) but in
+# linear time: the regex backtracks over the rest of the text for every tick that is not closed
+# before the next '>'. A quote starts at a run of ticks and ends at the last tick before the next
+# '>', or, when there is no later tick, at the end of the run if it is at least three ticks long.
+def removeQuoted( text ):
+    pieces = []
+    position = 0
+    searchFrom = 0
+    while True:
+        run = TICK_REGEX.search( text, searchFrom )
+        if run is None:
+            break
+        start, runEnd = run.span()
+        limit = text.find( ">", runEnd )
+        if limit == -1:
+            limit = len( text )
+        last = max( text.rfind( "`", runEnd + 1, limit ), text.rfind( "´", runEnd + 1, limit ) )
+        if last != -1:
+            end = last + 1
+        elif runEnd - start >= 3:
+            end = runEnd
+        else:
+            searchFrom = runEnd
+            continue
+        pieces.append( text[ position : start ] )
+        position = searchFrom = end
+    if position == 0:
+        return text
+    pieces.append( text[ position : ] )
+    return "".join( pieces )
+
+# Tokenizes all numbers of a text in a single linear pass. Maps the position where a unit
+# would start (right after the number and its trailing whitespace) to the start of the
+# number, its text and the start of its value (after the whitespace in front of it), so
+# finding the number in front of a unit needs no backward search.
+# Only the numbers that start from start up to end are tokenized, when given.
+def findNumbers( text, start=0, end=None ):
+    if end is None:
+        end = len( text )
+    numbers = {}
+    for numberResult in NUMBER_REGEX.finditer( text, start ):
+        if numberResult.start() >= end:
+            break
+        numbers[ numberResult.end(1) ] = ( numberResult.start(1), numberResult.group(1), numberResult.end(2) )
+    return numbers
+
+# The converted number keeps the spacing the user put between the number and the unit.
+def convertNumber( numberText, toMetric, context ):
+    prefix = numberText[ : len( numberText ) - len( numberText.lstrip() ) ]
+    spacing = numberText[ len( numberText.rstrip() ): ]
+    metricValue = toMetric( float( numberText.replace(",", ".") ), context.withSpacing( spacing ) )
+    if metricValue is None:
+        return
+    return prefix + metricValue
+
+# Converts values one by one, each with its own unit and spacing, with the same result as
+# unit.toMetric( value, context.withSpacing( spacing ) ) for each of them, but without creating
+# a context for every value.
+def convertValues( values, units, spacings, context=None ):
+    if context is None:
+        context = ConversionContext()
+    results = []
+    for value, unit, spacing in zip( values, units, spacings ):
+        SIValue = unit.toSI( value )
+        results.append( None if SIValue is None else unit.getUnitType().getSpacedString( SIValue, spacing, context ) )
+    return results
+
+# Like convertNumber for a list of numbers, each with its own unit, converted by convertValues.
+# The whitespace in front of the numbers is not part of the results, it stays in the text.
+def convertNumbers( numberTexts, units, context ):
+    values = []
+    spacings = []
+    for numberText in numberTexts:
+        values.append( float( numberText.replace(",", ".") ) )
+        spacings.append( numberText[ len( numberText.rstrip() ): ] )
+    return convertValues( values, units, spacings, context )
+
+# Replacements are (start, end, text) tuples, in the order of their start: the text from start up
+# to end is replaced by text. Builds the replaced text in a single join, or returns None when there
+# are no replacements.
+def joinReplacements( originalText, replacements ):
+    if not replacements:
+        return
+    pieces = []
+    lastPoint = 0
+    for start, end, text in replacements:
+        pieces.append( originalText[ lastPoint : start ] )
+        pieces.append( text )
+        lastPoint = end
+    pieces.append( originalText[ lastPoint : ] )
+    return "".join( pieces )
+
+def applyReplacements( message, originalText, replacements ):
+    if replacements:
+        message.setText( joinReplacements( originalText, replacements ) )
+
+def convertUnitInModificableMessage( message, unit_regex, toMetric, context=None ):
+    if context is None:
+        context = ConversionContext()
     originalText = message.getText()
-    if UNICODEMINUS:
+    if context.unicodeMinus:
         originalText = originalText.replace('−', '-')
+    numbers = findNumbers( originalText )
     iterator = unit_regex.finditer( originalText )
     replacements = []
     for find in iterator:
-        numberResult = END_NUMBER_REGEX.search( originalText[ 0 : find.start() ] )
-        if numberResult is not None:
-            initialSpaceCount = 0
-            prefix = ""
-            while (numberResult.group()[initialSpaceCount].isspace()):
-                prefix += numberResult.group()[initialSpaceCount]
-                initialSpaceCount += 1
-            old_spacing = SPACED
-            postSpaceCount = len(numberResult.group()) - 1
-            SPACED = ""
-            while (numberResult.group()[postSpaceCount].isspace()):
-                SPACED = numberResult.group()[postSpaceCount] + SPACED
-                postSpaceCount -= 1
-            metricValue = toMetric( float( numberResult.group().replace(",", ".") ) )
-            SPACED = old_spacing
-            if metricValue is None:
+        number = numbers.get( find.start() )
+        if number is not None:
+            text = convertNumber( number[1], toMetric, context )
+            if text is None:
                 continue
-            repl = {}
-            repl[ "start" ] = numberResult.start()
-            repl[ "text"  ] = (prefix) + metricValue
-            repl[ "end" ] = find.end()
-            replacements.append(repl)
-    if len(replacements)>0:
-        lastPoint = 0
-        finalMessage = ""
-        for repl in replacements:
-            finalMessage += originalText[ lastPoint: repl[ "start" ] ] + repl[ "text" ]
-            lastPoint = repl["end"]
-        finalMessage += originalText[ lastPoint : ]
-        message.setText(finalMessage)
+            replacements.append( ( number[0], find.end(), text ) )
+    applyReplacements( message, originalText, replacements )
 
 
 #NormalUnit class, that follow number + unit name.
 class NormalUnit( Unit ):
+    __slots__ = ("_pattern", "_regex")
+
     def __init__( self, friendlyName, regex, unitType, toSIMultiplication, toSIAddition = 0 ):
         super( NormalUnit, self ).__init__( friendlyName, unitType, toSIMultiplication, toSIAddition )
-        self._regex = re.compile( "(" + regex + ")(?=[!?.,()\"\']*(\\s|$))", re.IGNORECASE )
+        self._pattern = regex
+        # Messages are matched with the regex of the UnitMatcher. The regex of a single unit is only
+        # used by convert and after a declined value, so it is compiled the first time it is needed.
+        self._regex = None
+
+    def getPattern( self ):
+        return "(?i:" + self._pattern + ")"
+
+    def getRegex( self ):
+        if self._regex is None:
+            self._regex = re.compile( "(" + self._pattern + ")(?=[!?.,()\"\']*(\\s|$))", re.IGNORECASE )
+        return self._regex
 
-    def convert( self, message ):
-        convertUnitInModificableMessage( message, self._regex, self.toMetric )
+    def convert( self, message, context=None ):
+        convertUnitInModificableMessage( message, self.getRegex(), self.toMetric, context )
 
 class CaseSensitiveUnit( Unit ):
+    __slots__ = ("_pattern", "_regex")
+
     def __init__( self, friendlyName, regex, unitType, toSIMultiplication, toSIAddition = 0 ):
         super( CaseSensitiveUnit, self ).__init__( friendlyName, unitType, toSIMultiplication, toSIAddition )
-        self._regex = re.compile( "(" + regex + ")(?=[!?.,()\"\']*(\\s|$))" )
-    
-    def convert( self, message ):
-        return convertUnitInModificableMessage( message, self._regex, self.toMetric)
+        self._pattern = regex
+        # Compiled the first time it is needed, like the regex of NormalUnit.
+        self._regex = None
+
+    def getPattern( self ):
+        return "(?:" + self._pattern + ")"
+
+    def getRegex( self ):
+        if self._regex is None:
+            self._regex = re.compile( "(" + self._pattern + ")(?=[!?.,()\"\']*(\\s|$))" )
+        return self._regex
+
+    def convert( self, message, context=None ):
+        return convertUnitInModificableMessage( message, self.getRegex(), self.toMetric, context )
 
 # Class containing a string, for the modificable message, and a boolean
 # to indicate if the message has been modified
 class ModificableMessage:
+    __slots__ = ("_text", "_modified")
 
     def __init__(self, text):
         self._text = text
@@ -151,86 +343,531 @@ class ModificableMessage:
     def isModified(self):
         return self._modified
 
-units = []
-
-#Area
-units.append( NormalUnit( "inch squared", "in(ch(es)?)? ?(\^2|squared|²)", AREA, 0.00064516 ) )     #inch squared
-units.append( NormalUnit( "foot squared", "f(oo|ee)?t ?(\^2|squared|²)", AREA, 0.092903 ) )         #foot squared
-units.append( NormalUnit( "mile squared", "mi(les?)? ?(\^2|squared|²)", AREA, 2589990 ) )           #mile squared
-units.append( NormalUnit( "acre", "acres?", AREA, 4046.8564224 ) )                                  #acre
-units.append( NormalUnit( "rood", "roods?", AREA, 1011.7141 ) )                                     #rood
-
-#Volume
-units.append( NormalUnit( "pint", "pints?|pt", VOLUME, 0.473176 ) )                     #pint
-units.append( NormalUnit( "quart", "quarts?|qt", VOLUME, 0.946353 ) )                   #quart
-units.append( NormalUnit( "gallon", "gal(lons?)?", VOLUME, 3.78541 ) )                  #gallon
-units.append( NormalUnit( "fluid ounce", "fl\.? oz\.?", VOLUME, 0.0295735296 ) )        #fluid ounce
-units.append( NormalUnit( "teaspoon", "tsp|teaspoons?", VOLUME, 0.00492892159 ) )       #US teaspoon
-units.append( NormalUnit( "tablespoon", "tbsp|tablespoons?", VOLUME, 0.0147867648 ) )   #US tablespoon
-units.append( NormalUnit( "barrel", "drum|barrels?", VOLUME, 119.240471 ) )             #barrel
-units.append( NormalUnit( "peck", "pecks?", VOLUME, 8.809768 ) )                        #pecks
-units.append( NormalUnit( "bushel", "bushels?", VOLUME, 35.23907016688 ) )              #bushels
-
-#Energy
-units.append( NormalUnit( "foot-pound", "ft( |\*)?lbf?|foot( |-)pound", ENERGY, 1.355818 ) )                 #foot-pound
-units.append( NormalUnit( "British thermal unit", "btu", ENERGY, 1055.06 ) )                                 #British thermal unit
-units.append( CaseSensitiveUnit( "calories", "cal(ories?)?", ENERGY, 4.184 ) )                               #calories
-units.append( CaseSensitiveUnit( "kilocalories", "(k(ilo)?c|C)al(ories?)?", ENERGY, 4184 ) )       #kilocalories
-units.append( NormalUnit( "ton of refrigeration", "ton of refrigeration", POWER, 3500 ) )                    #ton of refrigeration
-units.append( NormalUnit( "ergs", "ergs?", ENERGY, 10**-7 ) )                                                #ergs
-
-#Force
-units.append( NormalUnit( "pound-force", "pound( |-)?force|lbf", FORCE, 4.448222 ) )            #pound-force
-
-#Torque
-units.append( NormalUnit( "pound-foot", "Pound(-| )?(f(oo|ee)?t)|lbf( |\*)?ft", TORQUE, 1.355818 ) )      #pound-foot
-
-#Velocity
-units.append( NormalUnit( "miles per hour", "miles? per hour|mph|mi/h", VELOCITY, 0.44704 ) )             #miles per hour
-units.append( NormalUnit( "knot", "knots?|kts?", VELOCITY, 0.51444444444 ) )                              #knots
-units.append( NormalUnit( "feet per second", "f(oo|ee)?t ?(per|/|p) ?s(ec|onds?)?", VELOCITY, 0.3048 ) )  #feet per second
-
-#Temperature
-units.append( NormalUnit( "degrees fahrenheit", "((°|º|deg(ree)?s?) ?)?(fahrenheit|freedom|f)", TEMPERATURE, 5/9, -32 ) )  #Degrees freedom
-units.append( NormalUnit( "degrees rankine", "((°|º|deg(ree)?s?) ?)?(ra?(nkine)?)", TEMPERATURE, 5/9, -491.67 ) )          #Degrees rankine
-
-#Pressure
-units.append( NormalUnit( "pound per square inch", "pounds?((-| )?force)? per square in(ch)?|lbf\/in\^2|psi", PRESSURE, 0.068046 ) ) #Pounds per square inch
-
-#Mass
-units.append( NormalUnit( "ounce", "ounces?|oz", MASS, 28.349523125 ) )                  #ounces
-units.append( NormalUnit( "pound", "pounds?|lbs?", MASS, 453.59237 ) )                   #pounds
-units.append( NormalUnit( "stone", "stones?|(?<!1)st", MASS, 6350.2293318 ) )            #stones
-units.append( NormalUnit( "grain", "grains?", MASS, 0.06479891 ) )                       #grains
-units.append( NormalUnit( "slug", "slugs?", MASS, 14593.9029 ) )                         #slug
-units.append( NormalUnit( "troy ounce", "troy ?ounces?", MASS, 31.1034768 ) )            #troy ounces
-units.append( NormalUnit( "pennyweight", "penny ?weights?", MASS, 1.55517384 ) )         #pennywheight
-units.append( NormalUnit( "troy pound", "troy ?pounds?", MASS, 373.2417216 ) )           #troy pound
-units.append( NormalUnit( "dram", "drams?", MASS, 1.7718451953125 ) )                    #drams
-units.append( NormalUnit( "hundredweight", "hundredweights?|cwt", MASS, 50802 ) )        #hundredweights
-
-#Distance
-units.append( NormalUnit( "inch", "inch(es)?", DISTANCE, 0.0254 ) )                           #inch
-units.append( NormalUnit( "foot", "f(oo|ee)?t", DISTANCE, 0.3048 ) )                      #foot
-units.append( NormalUnit( "mile", "mi(les?)?", DISTANCE, 1609.344 ) )                         #mile
-units.append( NormalUnit( "yard", "yd|yards?", DISTANCE, 0.9144 ) )                           #yard
-units.append( NormalUnit( "nautical mile", "nautical ?(mi(les?)?)?|nmi", DISTANCE, 1852 ) )   #nautical miles
-units.append( NormalUnit( "thou", "thou", DISTANCE, 0.0000254 ) )                             #thou
-units.append( NormalUnit( "fathom", "fathoms?", DISTANCE, 1.8288 ) )                          #fathom
-units.append( NormalUnit( "furlong", "furlongs?", DISTANCE, 201.1680 ) )                      #furlong
-units.append( NormalUnit( "rack unit", "rack ?units?|ru", DISTANCE, 0.04445 ) )               #rack units
-units.append( NormalUnit( "smoot", "smoots?", DISTANCE, 1.7018 ) )                            #Smoot units
-
-#Luminous intensity
-#units.append( NormalUnit( "Lumen", "lumens?|lm", LUMINOUSINTENSITY, 1 ) )          #lumens
-
-#Power
-units.append( NormalUnit( "horsepower", "horse ?power", POWER, 745.699872 ) )         #horsepower
+# Compiled dispatch engine: every unit pattern is joined into one alternation with a
+# named group per unit. The numbers of a message are tokenized in one pass and the
+# alternation is only tried right after each number, where a unit has to start.
+# Alternatives are tried in the order of the units list, so at any position the first
+# unit in the list wins, exactly like running the units one after another.
+class UnitMatcher:
+
+    def __init__(self, units):
+        self._units = list(units)
+        self._groups = {}
+        alternatives = []
+        for index, unit in enumerate(self._units):
+            name = "u" + str(index)
+            self._groups[name] = index
+            alternatives.append("(?P<" + name + ">" + unit.getPattern() + ")")
+        self._regex = re.compile("(?:" + "|".join(alternatives) + ")(?=[!?.,()\"\']*(?:\\s|$))")
+
+    def getUnits(self):
+        return self._units
+
+    # Returns the replacements for the units in text, for the numbers that start from start up to end.
+    # Raises TimeBudgetExceeded when the thread's CPU time passes the deadline.
+    # When metrics (see instrumentation.Metrics) are given, the time spent matching and formatting
+    # is recorded as the "match" and "format" stages, and every conversion is counted for its unit.
+    def findReplacements(self, text, context, deadline=None, metrics=None, start=0, end=None):
+        if metrics is not None:
+            startTime = time.perf_counter()
+        numbers = findNumbers(text, start, end)
+        matches = []
+        numberTexts = []
+        matchedUnits = []
+        for position, number in numbers.items():
+            checkDeadline(deadline)
+            find = self._regex.match(text, position)
+            if find is not None:
+                index = self._groups[find.lastgroup]
+                matches.append((position, number, index, find.end()))
+                numberTexts.append(number[1])
+                matchedUnits.append(self._units[index])
+        checkDeadline(deadline)
+        if metrics is not None:
+            formatStart = time.perf_counter()
+        # The values of the message are converted after all units are matched.
+        texts = convertNumbers(numberTexts, matchedUnits, context)
+        replacements = []
+        for (position, number, index, matchEnd), converted in zip(matches, texts):
+            matchedUnit = self._units[index]
+            # A unit that declines the value (zero without offset) leaves the
+            # position to the next unit in the list that matches there.
+            for unit in self._units[index + 1:]:
+                if converted is not None:
+                    break
+                unitFind = unit.matchAt(text, position)
+                if unitFind is not None:
+                    matchedUnit = unit
+                    converted = convertNumbers([number[1]], [unit], context)[0]
+                    matchEnd = unitFind.end()
+            if converted is None:
+                continue
+            if metrics is not None:
+                metrics.countUnit(matchedUnit.getName())
+            # Starts at the value, so the whitespace in front of the number is kept from the text.
+            replacements.append((number[2], matchEnd, converted))
+        if metrics is not None:
+            formatTime = time.perf_counter() - formatStart
+            metrics.observe("match", time.perf_counter() - startTime - formatTime)
+            metrics.observe("format", formatTime)
+        return replacements
+
+    # Like findReplacements, for a text that is an edit of oldText, in which oldReplacements were found.
+    # A unit match only depends on the text from its number onwards, so the matches after the changed
+    # part stay the same, moved by the change in length. Only the numbers from EDITCONTEXT characters
+    # before the changed part up to its end are matched again.
+    def findEditedReplacements(self, oldText, oldReplacements, text, context, deadline=None, metrics=None):
+        prefix = 0
+        shortest = min(len(oldText), len(text))
+        while prefix < shortest and oldText[prefix] == text[prefix]:
+            prefix += 1
+        if prefix == len(oldText) == len(text):
+            return list(oldReplacements)
+        suffix = 0
+        while suffix < shortest - prefix and oldText[-1 - suffix] == text[-1 - suffix]:
+            suffix += 1
+        shift = len(text) - len(oldText)
+        # A number at the very start of a text is matched differently (see NUMBER_REGEX), so the numbers
+        # at the start of both texts are always matched again, and never reused.
+        oldEnd = max(len(oldText) - suffix, 1, 1 - shift)
+        end = oldEnd + shift
+        start = max(prefix - EDITCONTEXT, 0)
+        # Numbers start at whitespace, so a long number that crosses start is matched again as a whole.
+        while start > 0 and not text[start - 1].isspace():
+            start -= 1
+        # Any amount of whitespace can separate a number from its unit, so the token in front of the
+        # whitespace before start is matched again too, in case it is the number of a unit after start.
+        while start > 0 and text[start - 1].isspace():
+            start -= 1
+        while start > 0 and not text[start - 1].isspace():
+            start -= 1
+        # NUMBER_REGEX matches a number together with the whitespace in front of it.
+        start = max(start - 1, 0)
+        before = []
+        after = []
+        for replacement in oldReplacements:
+            # The number of a replacement starts at the whitespace right in front of it, or at the start of the text.
+            numberStart = max(replacement[0] - 1, 0)
+            if numberStart >= oldEnd:
+                after.append((replacement[0] + shift, replacement[1] + shift, replacement[2]))
+            elif replacement[1] < start:
+                before.append(replacement)
+            else:
+                start = min(start, numberStart)
+        return before + self.findReplacements(text, context, deadline, metrics, start, end) + after
+
+    # Returns text with its units converted, or None when it has none.
+    def convertText(self, text, context=None, deadline=None, metrics=None):
+        if context is None:
+            context = ConversionContext()
+        if context.unicodeMinus:
+            text = text.replace('−', '-')
+        return joinReplacements(text, self.findReplacements(text, context, deadline, metrics))
+
+    def convert(self, message, context=None, deadline=None, metrics=None):
+        text = self.convertText(message.getText(), context, deadline, metrics)
+        if text is not None:
+            message.setText(text)
+
+# Raised when the unit table is not valid.
+class UnitRegistryError(ValueError):
+    pass
+
+UNIT_KEYS = ("name", "regex", "type", "factor", "offset", "caseSensitive")
+REQUIRED_UNIT_KEYS = ("name", "regex", "type", "factor")
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# Whether a unit regex can match text that starts with whitespace or a digit. The re module has no
+# public way to list the first characters of a regex, so it is tried on such a character followed by
+# samples of the text it is meant to match: the name of the unit and the letters in the regex.
+def _canStartWithSpaceOrDigit(regex, name):
+    samples = {"", name, name.replace(" ", "")}
+    samples.update(name.split())
+    words = re.findall("[^\\W\\d_]+", regex.pattern)
+    samples.update(words)
+    samples.update(word[1:] for word in words)
+    samples.update(("".join(words), " ".join(words)))
+    return any(regex.match(character + sample) for character in " \t\n\u00a00123456789" for sample in samples)
+
+# Checks a unit table (see units.json), raising UnitRegistryError for the first problem found.
+def validateUnitTable(table):
+    if not isinstance(table, dict) or not isinstance(table.get("unitTypes"), dict) or not isinstance(table.get("units"), list):
+        raise UnitRegistryError("The unit table needs a 'unitTypes' object and a 'units' list")
+    for typeName, multiples in table["unitTypes"].items():
+        # Unit types become module level names, so they must look like constants.
+        if not re.fullmatch("[A-Z][A-Z0-9_]*", typeName):
+            raise UnitRegistryError("Unit type name '{}' is not an uppercase name".format(typeName))
+        # And must not replace the options (SPACED, UNITS_FILE, ...) or other names of this module.
+        if typeName in globals() and not isinstance(globals()[typeName], UnitType):
+            raise UnitRegistryError("Unit type name '{}' is already used by unitconversion".format(typeName))
+        if not isinstance(multiples, dict) or not multiples:
+            raise UnitRegistryError("Unit type '{}' has no multiples".format(typeName))
+        for symbol, multiple in multiples.items():
+            if not _isNumber(multiple) or multiple <= 0:
+                raise UnitRegistryError("Multiple '{}' of unit type '{}' is not a positive number".format(symbol, typeName))
+    names = set()
+    for position, unit in enumerate(table["units"]):
+        if not isinstance(unit, dict):
+            raise UnitRegistryError("Unit #{} is not an object".format(position))
+        name = unit.get("name", "#" + str(position))
+        missing = [key for key in REQUIRED_UNIT_KEYS if key not in unit]
+        if missing:
+            raise UnitRegistryError("Unit '{}' is missing {}".format(name, ", ".join(missing)))
+        unknown = [key for key in unit if key not in UNIT_KEYS]
+        if unknown:
+            raise UnitRegistryError("Unit '{}' has unknown keys {}".format(name, ", ".join(unknown)))
+        if not isinstance(name, str) or not name or name in names:
+            raise UnitRegistryError("Unit '{}' needs a unique, non empty name".format(name))
+        names.add(name)
+        if unit["type"] not in table["unitTypes"]:
+            raise UnitRegistryError("Unit '{}' has unknown unit type '{}'".format(name, unit["type"]))
+        if not _isNumber(unit["factor"]) or unit["factor"] == 0:
+            raise UnitRegistryError("Unit '{}' needs a non zero number as factor".format(name))
+        if not _isNumber(unit.get("offset", 0)):
+            raise UnitRegistryError("Unit '{}' needs a number as offset".format(name))
+        if not isinstance(unit.get("caseSensitive", False), bool):
+            raise UnitRegistryError("Unit '{}' needs true or false as caseSensitive".format(name))
+        if not isinstance(unit["regex"], str):
+            raise UnitRegistryError("Unit '{}' needs a string as regex".format(name))
+        try:
+            regex = re.compile(unit["regex"])
+        except re.error as error:
+            raise UnitRegistryError("Unit '{}' has an invalid regex: {}".format(name, error))
+        # A unit that matches empty text would convert every number followed by a space.
+        if regex.fullmatch("") is not None:
+            raise UnitRegistryError("Unit '{}' has a regex that matches empty text".format(name))
+        # The prefilter and findNumbers expect a unit right after the whitespace that follows a number.
+        if _canStartWithSpaceOrDigit(regex, name):
+            raise UnitRegistryError("Unit '{}' has a regex that can start with whitespace or a digit".format(name))
+
+# The unit types and units of a (valid) unit table, and the matcher for them.
+# Every registry gets its own generation number, which tells results of different tables apart.
+class UnitRegistry:
+    _generations = count()
+
+    def __init__(self, table):
+        self.generation = next(UnitRegistry._generations)
+        self.unitTypes = {}
+        for typeName, multiples in table["unitTypes"].items():
+            unitType = UnitType()
+            for symbol, multiple in multiples.items():
+                unitType.addMultiple(symbol, multiple)
+            self.unitTypes[typeName] = unitType
+        self.units = []
+        for unit in table["units"]:
+            unitClass = CaseSensitiveUnit if unit.get("caseSensitive", False) else NormalUnit
+            self.units.append(unitClass(unit["name"], unit["regex"], self.unitTypes[unit["type"]], unit["factor"], unit.get("offset", 0)))
+        self.matcher = UnitMatcher(self.units)
+
+# Part of the key of the cached unit table. Changed whenever validateUnitTable accepts fewer tables,
+# so tables cached before are validated again.
+_TABLE_CACHE_VERSION = 3
+
+def _readCachedTable(cachePath, key):
+    try:
+        with open(cachePath, "rb") as cacheFile:
+            cached = marshal.load(cacheFile)
+        if cached["key"] == key:
+            return cached
+    except Exception:
+        # A missing, stale or corrupt cache only means the unit table is read and validated again.
+        pass
+
+def _writeCachedTable(cachePath, cached):
+    temporaryPath = "{}.{}.tmp".format(cachePath, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(temporaryPath, "wb") as cacheFile:
+            marshal.dump(cached, cacheFile)
+        # Replaced in one step, so other processes never read a half written cache.
+        os.replace(temporaryPath, cachePath)
+    except (OSError, ValueError):
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+
+# Loads the unit table from path. The validated table is cached in cachePath, keyed on the content
+# of the file, _TABLE_CACHE_VERSION and the Python version, so a process started with an unchanged
+# table skips parsing and validating it. None as cachePath disables the cache.
+# The cache is written with marshal, which (unlike pickle and json) is built into the interpreter,
+# so a warm start imports nothing besides the unit table. Its format depends on the Python version.
+def loadRegistry(path=UNITS_FILE, cachePath=UNITS_CACHE_FILE):
+    with open(path, "rb") as unitsFile:
+        content = unitsFile.read()
+    key = (_TABLE_CACHE_VERSION, sys.version, content)
+    cached = _readCachedTable(cachePath, key) if cachePath else None
+    if cached is not None:
+        return UnitRegistry(cached["table"])
+    # Only imported when the table has to be parsed, see above.
+    import json
+    try:
+        table = json.loads(content.decode("utf-8"))
+    except ValueError as error:
+        raise UnitRegistryError("{} is not a valid unit table: {}".format(path, error))
+    validateUnitTable(table)
+    registry = UnitRegistry(table)
+    if cachePath:
+        _writeCachedTable(cachePath, {"key": key, "table": table})
+    return registry
+
+registry = loadRegistry()
+units = registry.units
+matcher = registry.matcher
+# The unit types are module level names (DISTANCE, AREA, ...), like when they were defined in this file.
+globals().update(registry.unitTypes)
+
+_reloadLock = threading.Lock()
+
+# Loads the unit table again and swaps it in, without restarting. The new registry is built
+# completely before it replaces the old one in a single assignment, and process reads the
+# registry once per message, so a message is converted with either the old or the new table.
+# When the new table is not valid this raises UnitRegistryError and the old one stays in use.
+def reloadUnits(path=UNITS_FILE, cachePath=UNITS_CACHE_FILE):
+    global registry, units, matcher
+    with _reloadLock:
+        newRegistry = loadRegistry(path, cachePath)
+        registry = newRegistry
+        units = newRegistry.units
+        matcher = newRegistry.matcher
+        globals().update(newRegistry.unitTypes)
+        clearCache()
+    return newRegistry
+
+# Bounded LRU cache for the results of process, for messages that are repeated a lot (copypasta,
+# bots reposting, ...). Keyed on the message after REMOVE_REGEX, the conversion options and the
+# generation of the unit registry, so results of a unit table that was reloaded are never returned.
+# Entries are limited both in number and in approximate bytes, as messages can be up to 4000
+# characters long, and optionally expire after ttl seconds.
+class ResultCache:
+
+    def __init__(self, maxEntries=1024, maxBytes=4 * 1024 * 1024, ttl=None):
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    # Returns a tuple (found, result), as None is a valid result.
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                self._remove(key)
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, result):
+        size = sys.getsizeof(key[0]) + sys.getsizeof(result)
+        if size > self._maxBytes:
+            return
+        expires = time.monotonic() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, expires, size)
+            self._bytes += size
+            while len(self._entries) > self._maxEntries or self._bytes > self._maxBytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def getStats(self):
+        return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# The result cache of process. None (the default) means results are not cached.
+resultCache = None
+
+def enableCache(maxEntries=1024, maxBytes=4 * 1024 * 1024, ttl=None):
+    global resultCache
+    resultCache = ResultCache(maxEntries, maxBytes, ttl)
+    return resultCache
+
+def disableCache():
+    global resultCache
+    resultCache = None
+
+# Should be called when the units or the module level options change.
+def clearCache():
+    if resultCache is not None:
+        resultCache.clear()
+
+# Counters for the pre-filter in process, to keep an eye on its hit rate.
+prefilterStats = {"checked": 0, "rejected": 0}
+# Counts the messages whose conversion was skipped because they took longer than their time budget.
+budgetStats = {"exceeded": 0}
+
+# Cheap O(len) check that tells whether a message could contain a convertible unit at all.
+def mayContainUnits(message):
+    prefilterStats["checked"] += 1
+    if PREFILTER_REGEX.search(message) is None:
+        prefilterStats["rejected"] += 1
+        return False
+    return True
+
+# The instrumentation.Metrics that process records stage latencies, outcomes and unit hits in.
+# None (the default) means nothing is recorded.
+metrics = None
+
+def enableMetrics(newMetrics=None):
+    global metrics
+    if newMetrics is None:
+        import instrumentation
+        newMetrics = instrumentation.Metrics()
+    metrics = newMetrics
+    return metrics
+
+def disableMetrics():
+    global metrics
+    metrics = None
 
 #Processes a string, converting freedom units to science units.
-def process(message):
-    modificableMessage = ModificableMessage(REMOVE_REGEX.sub("", message))
-    for u in units:
-        u.convert(modificableMessage)
-    if modificableMessage.isModified():
-        return modificableMessage.getText()
+#Does not modify any shared state besides the statistics counters, so it can be called from several threads at once.
+def process(message, context=None):
+    recorder = metrics
+    if recorder is not None:
+        lapTime = time.perf_counter()
+    if not mayContainUnits(message):
+        if recorder is not None:
+            recorder.lap("prefilter", lapTime)
+            recorder.countOutcome("prefiltered")
+        return
+    if recorder is not None:
+        lapTime = recorder.lap("prefilter", lapTime)
+    if context is None:
+        context = ConversionContext()
+    deadline = context.getDeadline()
+    text = removeQuoted(message)
+    if recorder is not None:
+        recorder.lap("remove_quoted", lapTime)
+    current = registry
+    cache = resultCache
+    if cache is not None:
+        key = (text, context.getKey(), current.generation)
+        found, result = cache.get(key)
+        if found:
+            if recorder is not None:
+                recorder.countOutcome("cached")
+            return result
+    try:
+        checkDeadline(deadline)
+        result = current.matcher.convertText(text, context, deadline, recorder)
+    except TimeBudgetExceeded:
+        budgetStats["exceeded"] += 1
+        if recorder is not None:
+            recorder.countOutcome("over_budget")
+        return
+    if cache is not None:
+        cache.put(key, result)
+    if recorder is not None:
+        recorder.countOutcome("unchanged" if result is None else "converted")
+    return result
+
+# The conversion of a message by processIncremental: the text the units were matched in (the message
+# without quotes), the replacements found in it, and the result, the same as process returns.
+# Keyed on the conversion options and the unit registry it was made with, like the result cache.
+# The text and replacements are None when they are not known, for a message that was pre-filtered
+# or found in the result cache; an edit of such a message is converted in full.
+class Conversion:
+    __slots__ = ("text", "replacements", "result", "key")
+
+    def __init__(self, text, replacements, result, key):
+        self.text = text
+        self.replacements = replacements
+        self.result = result
+        self.key = key
+
+    def isReusable(self, key):
+        return self.replacements is not None and self.key == key
+
+#Processes a string like process, with the same pre-filter, result cache, time budget and metrics,
+#returning a Conversion, or None when it went over the time budget.
+#When previous is the Conversion of an earlier version of the message, before it was edited, only
+#the changed part is matched again, see UnitMatcher.findEditedReplacements.
+def processIncremental(message, previous=None, context=None):
+    recorder = metrics
+    if recorder is not None:
+        lapTime = time.perf_counter()
+    if context is None:
+        context = ConversionContext()
+    current = registry
+    key = (context.getKey(), current.generation)
+    if not mayContainUnits(message):
+        if recorder is not None:
+            recorder.lap("prefilter", lapTime)
+            recorder.countOutcome("prefiltered")
+        return Conversion(None, None, None, key)
+    if recorder is not None:
+        lapTime = recorder.lap("prefilter", lapTime)
+    deadline = context.getDeadline()
+    quotedText = removeQuoted(message)
+    if recorder is not None:
+        recorder.lap("remove_quoted", lapTime)
+    text = quotedText.replace('−', '-') if context.unicodeMinus else quotedText
+    reuse = previous is not None and previous.isReusable(key)
+    cache = resultCache
+    if cache is not None:
+        cacheKey = (quotedText, context.getKey(), current.generation)
+        # An edit is matched again from the previous conversion instead, which also gives its replacements.
+        if not reuse:
+            found, result = cache.get(cacheKey)
+            if found:
+                if recorder is not None:
+                    recorder.countOutcome("cached")
+                return Conversion(text, [] if result is None else None, result, key)
+    try:
+        checkDeadline(deadline)
+        if reuse:
+            replacements = current.matcher.findEditedReplacements(previous.text, previous.replacements, text, context, deadline, recorder)
+        else:
+            replacements = current.matcher.findReplacements(text, context, deadline, recorder)
+    except TimeBudgetExceeded:
+        budgetStats["exceeded"] += 1
+        if recorder is not None:
+            recorder.countOutcome("over_budget")
+        return
+    result = joinReplacements(text, replacements)
+    if cache is not None:
+        cache.put(cacheKey, result)
+    if recorder is not None:
+        recorder.countOutcome("unchanged" if result is None else "converted")
+    return Conversion(text, replacements, result, key)
+
+#Processes many strings lazily, yielding the result of process for each of them in order.
+#The context is set up once for all messages. When processes is given, the messages are
+#converted by a multiprocessing pool in chunks, reading at most a few chunks ahead of the output.
+def process_many(messages, context=None, processes=None, chunksize=256):
+    if context is None:
+        context = ConversionContext()
+    if not processes:
+        for message in messages:
+            yield process(message, context)
+        return
+    # Imported here, so importing this module (and starting a worker process) does not need multiprocessing.
+    from multiprocessing import Pool
+    convert = partial(process, context=context)
+    messages = iter(messages)
+    with Pool(processes) as pool:
+        while True:
+            batch = list(islice(messages, chunksize * processes * 4))
+            if not batch:
+                return
+            yield from pool.imap(convert, batch, chunksize)
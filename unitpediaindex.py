@@ -0,0 +1,154 @@
+'''Index for the unitpedia, so a lookup does not need to run the regex of every article.'''
+
+from bisect import bisect_left
+
+MAX_ALIASES = 10000    # Patterns that match more strings than this are not expanded, but matched with their regex.
+
+
+class UnsupportedPattern(Exception):
+    pass
+
+
+class _PatternExpander:
+    '''Expands a finite regex into all the strings it matches.
+
+    Supports literals, escaped punctuation, groups (also (?:...)), alternation, '?' and the anchors
+    '^' and '$'. Anything else (character classes, repetition, ...) raises UnsupportedPattern.
+    '''
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+        self._position = 0
+
+    def _peek(self):
+        if self._position < len(self._pattern):
+            return self._pattern[self._position]
+
+    def expand(self):
+        strings = self._parseAlternation()
+        if self._position != len(self._pattern):
+            raise UnsupportedPattern(self._pattern)
+        return strings
+
+    def _parseAlternation(self):
+        strings = self._parseSequence()
+        while self._peek() == "|":
+            self._position += 1
+            strings = strings | self._parseSequence()
+        return strings
+
+    def _parseSequence(self):
+        strings = {""}
+        while self._peek() not in (None, "|", ")"):
+            atom = self._parseAtom()
+            if self._peek() == "?":
+                self._position += 1
+                atom = atom | {""}
+            strings = {start + end for start in strings for end in atom}
+            if len(strings) > MAX_ALIASES:
+                raise UnsupportedPattern(self._pattern)
+        return strings
+
+    def _parseAtom(self):
+        char = self._peek()
+        self._position += 1
+        if char == "(":
+            if self._pattern.startswith("?:", self._position):
+                self._position += 2
+            elif self._peek() == "?":
+                raise UnsupportedPattern(self._pattern)
+            strings = self._parseAlternation()
+            if self._peek() != ")":
+                raise UnsupportedPattern(self._pattern)
+            self._position += 1
+            return strings
+        if char == "\\":
+            escaped = self._peek()
+            if escaped is None or escaped.isalnum():
+                raise UnsupportedPattern(self._pattern)
+            self._position += 1
+            return {escaped}
+        if char in "^$":
+            # Anchors match no text. Aliases are checked against the regex afterwards, which drops
+            # any alias that an anchor in the middle of the pattern would not allow.
+            return {""}
+        if char in "[].*+{}?":
+            raise UnsupportedPattern(self._pattern)
+        return {char}
+
+
+def expandPattern(pattern):
+    '''Returns the set of all strings a finite pattern matches, or None when it cannot be expanded.'''
+    try:
+        return _PatternExpander(pattern).expand()
+    except UnsupportedPattern:
+        return None
+
+
+def trigrams(text):
+    text = " " + text + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ArticleIndex:
+    '''Finds the first article whose (case insensitive) regex fully matches a search.
+
+    The patterns are expanded into a hash map of lowercase aliases at build time, so looking up a
+    known alias is O(1) however many articles there are. Articles whose pattern cannot be expanded
+    are still matched with their regex. Also keeps sorted aliases and a trigram index to suggest
+    articles for searches that do not match any.
+    '''
+
+    def __init__(self, regexes):
+        self._regexes = list(regexes)
+        self._aliases = {}
+        self._fallback = []
+        self._trigrams = {}
+        for position, regex in enumerate(self._regexes):
+            aliases = expandPattern(regex.pattern)
+            if aliases is None:
+                self._fallback.append(position)
+                continue
+            for alias in aliases:
+                if alias and regex.fullmatch(alias):
+                    self._aliases.setdefault(alias.lower(), position)
+        for alias, position in self._aliases.items():
+            for gram in trigrams(alias):
+                self._trigrams.setdefault(gram, set()).add(position)
+        self._sortedAliases = sorted(self._aliases)
+
+    def getAliasCount(self):
+        return len(self._aliases)
+
+    def find(self, search):
+        '''Returns the position of the first article whose regex fully matches search, or None.'''
+        position = self._aliases.get(search.lower())
+        if position is not None and not self._regexes[position].fullmatch(search):
+            position = None
+        for fallbackPosition in self._fallback:
+            if position is not None and fallbackPosition > position:
+                break
+            if self._regexes[fallbackPosition].fullmatch(search):
+                return fallbackPosition
+        return position
+
+    def suggest(self, search, limit=3):
+        '''Returns the positions of up to limit articles with an alias starting with search,
+        followed by the articles sharing the most trigrams with it.'''
+        key = search.lower()
+        suggestions = []
+        for alias in self._sortedAliases[bisect_left(self._sortedAliases, key):]:
+            if len(suggestions) >= limit or not alias.startswith(key):
+                break
+            if self._aliases[alias] not in suggestions:
+                suggestions.append(self._aliases[alias])
+        scores = {}
+        for gram in trigrams(key):
+            for position in self._trigrams.get(gram, ()):
+                scores[position] = scores.get(position, 0) + 1
+        for position in sorted(scores, key=lambda position: (-scores[position], position)):
+            if len(suggestions) >= limit:
+                break
+            if position not in suggestions:
+                suggestions.append(position)
+        return suggestions